@@ -1,15 +1,44 @@
 import os
-from flask import Flask, request, abort, render_template, redirect, url_for, flash
+import time
+_module_load_started = time.time() # ใช้วัดเวลา startup
+from flask import Flask, request, abort, render_template, redirect, url_for, flash, jsonify, Response, stream_with_context
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+import requests
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 import json
-import time
+import csv
+import io
 import logging
+import importlib
+import re
+import math
+import difflib
+import threading
+import functools
+import contextvars
+import uuid
+import random
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# --- Import แบบ Lazy ---
+# openai และ firebase_admin.firestore ใช้เวลา import รวมเกือบ 1 วินาที จึง import เมื่อใช้งานครั้งแรก
+# (ถ้ารัน gunicorn แบบ preload จะ import ใน master process ครั้งเดียวผ่าน preload_modules())
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
 
 # --- OpenAI Import ---
-import openai
-from openai import OpenAI # ใช้สำหรับ OpenAI Python SDK v1.x.x ขึ้นไป
+openai = LazyModule("openai") # ใช้สำหรับ OpenAI Python SDK v1.x.x ขึ้นไป
 
 # ตั้งค่า Logging ให้เห็น DEBUG message ใน Render logs
 logging.basicConfig(level=logging.INFO)
@@ -17,8 +46,7 @@ app_logger = logging.getLogger('app_logger')
 app_logger.setLevel(logging.DEBUG)
 
 # --- Firebase Imports ---
-import firebase_admin
-from firebase_admin import credentials, firestore
+firestore = LazyModule("firebase_admin.firestore")
 
 # --- กำหนดค่า Config (ต้องเปลี่ยนเป็นค่าของคุณเอง) ---
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
@@ -27,34 +55,192 @@ LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") 
 FIREBASE_SERVICE_ACCOUNT_JSON = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
 FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY", "your_super_secret_key_for_flask_messages")
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me") # เปลี่ยนได้เพื่อใช้กับ server จำลอง
+
+# --- Config สำหรับ Startup และ Connection Pool ---
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10")) # จำนวน keep-alive connection สูงสุดต่อ host
+WARM_UP_ON_START = os.getenv("WARM_UP_ON_START", "1") == "1" # ให้ gunicorn เรียก warm_up() หลัง fork worker
+
+# --- Config สำหรับการประมวลผล Webhook แบบ Asynchronous ---
+# WEBHOOK_ASYNC_MODE=1 : ตอบ 200 ให้ LINE ทันทีหลังตรวจ signature แล้วส่งงานไปทำใน worker pool
+WEBHOOK_ASYNC_MODE = os.getenv("WEBHOOK_ASYNC_MODE", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8")) # จำนวน thread ที่ประมวลผลพร้อมกัน
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "64")) # จำนวนงานที่รอคิวได้สูงสุด (นอกเหนือจากที่กำลังทำ)
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", "0.5")) # วินาทีที่ยอมรอเมื่อคิวเต็ม ก่อนตอบ 503
+
+# --- Config สำหรับ Cache ข้อมูลสินค้าในหน่วยความจำ ---
+PRODUCT_CACHE_ENABLED = os.getenv("PRODUCT_CACHE_ENABLED", "1") == "1"
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "300")) # วินาที ใช้ reload ใหม่เมื่อ snapshot listener หลุด
+
+# --- Config สำหรับการระบุเจตนาในเครื่อง (ข้ามการเรียก OpenAI ครั้งแรก) ---
+FAST_INTENT_ENABLED = os.getenv("FAST_INTENT_ENABLED", "1") == "1"
+FAST_INTENT_MIN_CONFIDENCE = float(os.getenv("FAST_INTENT_MIN_CONFIDENCE", "0.85"))
+
+# --- Config เลือก pipeline สำหรับสร้างคำตอบ ---
+# "two_call" : ระบุเจตนา (JSON) แล้วจึงสร้างคำตอบ (แบบเดิม)
+# "tools"    : ให้ GPT เรียก get_product_data ผ่าน tool calling และ stream คำตอบในบทสนทนาเดียว
+ANSWER_PIPELINE = os.getenv("ANSWER_PIPELINE", "two_call")
+ANSWER_PIPELINES = ("two_call", "tools")
+
+# --- Config สำหรับ Cache ผลลัพธ์จาก OpenAI (เจตนาและคำตอบ) ---
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000")) # จำนวน entry สูงสุดต่อ cache
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600")) # วินาที
+
+# --- Config สำหรับ Query สินค้าแบบกรอง/เรียง/จำกัดจำนวน ---
+PRODUCT_QUERY_DEFAULT_LIMIT = int(os.getenv("PRODUCT_QUERY_DEFAULT_LIMIT", "10"))
+PRODUCT_QUERY_MAX_LIMIT = int(os.getenv("PRODUCT_QUERY_MAX_LIMIT", "50"))
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "10"))
+
+# --- Config สำหรับ Metrics และ Trace ID ---
+LOG_TRACE_IDS = os.getenv("LOG_TRACE_IDS", "0") == "1" # ใส่ trace ID ของแต่ละ request ใน log
+# gunicorn มีหลาย worker แต่ละตัวนับ metrics แยกกัน: ตั้ง METRICS_DIR ให้ทุก worker เขียน snapshot ลงโฟลเดอร์เดียวกัน
+# แล้ว /metrics (ไม่ว่าจะถูกส่งไป worker ไหน) จะรวมค่าจากทุกไฟล์ (gunicorn.conf.py ตั้งค่าให้อัตโนมัติ)
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5")) # วินาทีระหว่างการเขียน snapshot ของแต่ละ worker
+
+# --- Config สำหรับกัน Webhook ซ้ำ และจำกัดอัตราข้อความต่อผู้ใช้ ---
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "3600")) # วินาทีที่จำ event ID ไว้
+IDEMPOTENCY_MAX_EVENTS = int(os.getenv("IDEMPOTENCY_MAX_EVENTS", "50000"))
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory") # "memory" หรือ "firestore" (ใช้ร่วมกันหลาย instance)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))
+
+# --- Config สำหรับการเรียกบริการภายนอก (timeout, retry, hedging, circuit breaker) ---
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "30")) # วินาทีที่ถือว่า reply token ยังใช้ได้ (นับจาก timestamp ของ event)
+REPLY_RESERVE_SECONDS = float(os.getenv("REPLY_RESERVE_SECONDS", "3")) # เวลาที่กันไว้สำหรับเรียก reply_message ของ LINE
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "15")) # timeout สูงสุดต่อการเรียก OpenAI หนึ่งครั้ง
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "3"))
+LINE_TIMEOUT = float(os.getenv("LINE_TIMEOUT", "5")) # timeout ของการเรียก LINE Messaging API
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "2"))
+OUTBOUND_RETRY_BASE_DELAY = float(os.getenv("OUTBOUND_RETRY_BASE_DELAY", "0.2")) # วินาที (exponential backoff + jitter)
+OUTBOUND_RETRY_MAX_DELAY = float(os.getenv("OUTBOUND_RETRY_MAX_DELAY", "2"))
+INTENT_HEDGE_DELAY = float(os.getenv("INTENT_HEDGE_DELAY", "0")) # ส่งคำขอระบุเจตนาซ้ำถ้าช้ากว่านี้ (วินาที), 0 = ปิด
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")) # error ติดกันกี่ครั้งจึงตัดวงจร
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30")) # วินาทีก่อนลองเรียกใหม่ (half-open)
+FALLBACK_MAX_PRODUCTS = int(os.getenv("FALLBACK_MAX_PRODUCTS", "5")) # จำนวนสินค้าในคำตอบสำรองเมื่อเรียก AI ไม่ได้
+
+# --- Config สำหรับหน้า Admin และการ Import/Export ---
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+ADMIN_MAX_PAGE_SIZE = int(os.getenv("ADMIN_MAX_PAGE_SIZE", "500"))
+FIRESTORE_BATCH_LIMIT = 500 # Firestore จำกัด 500 operation ต่อ batch
+
+# --- Config งบ Token สำหรับข้อมูลสินค้าใน Prompt ---
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
 
 # ตรวจสอบว่าได้ตั้งค่า Environment Variables แล้ว
 if not LINE_CHANNEL_ACCESS_TOKEN: raise ValueError("LINE_CHANNEL_ACCESS_TOKEN is not set.")
 if not LINE_CHANNEL_SECRET: raise ValueError("LINE_CHANNEL_SECRET is not set.")
 if not OPENAI_API_KEY: raise ValueError("OPENAI_API_KEY is not set.") # ตรวจสอบ OpenAI Key
 if not FIREBASE_SERVICE_ACCOUNT_JSON: raise ValueError("FIREBASE_SERVICE_ACCOUNT_JSON is not set.")
+if ANSWER_PIPELINE not in ANSWER_PIPELINES:
+    raise ValueError(f"Unknown ANSWER_PIPELINE '{ANSWER_PIPELINE}' (expected {' or '.join(repr(name) for name in ANSWER_PIPELINES)}).")
+
+# --- Client แบบ Lazy (สร้างเมื่อใช้งานครั้งแรกในแต่ละ worker) ---
+# ไม่สร้าง client ก่อน gunicorn fork เพราะ gRPC ของ Firestore และ connection pool ใช้ร่วมข้าม process ไม่ได้
+# เรียก warm_up() หลัง fork เพื่อสร้าง client และเปิด connection ไว้ก่อนข้อความแรกเข้ามา
+startup_stats = {
+    "import_seconds": None,
+    "client_init_seconds": {},
+    "warm_up_seconds": None,
+    "first_reply_seconds": None, # นับจากเวลาที่ worker เริ่มทำงาน
+}
+_worker_started_at = _module_load_started
+
+class LazyClient:
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    start_time = time.time()
+                    self._client = self._factory()
+                    startup_stats["client_init_seconds"][self._name] = round(time.time() - start_time, 3)
+                    app_logger.info(f"{self._name} client initialized in {time.time() - start_time:.2f} seconds")
+        return self._client
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
 
 # --- ตั้งค่า Firebase ---
-try:
-    cred_json = json.loads(FIREBASE_SERVICE_ACCOUNT_JSON)
-    cred = credentials.Certificate(cred_json)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    app_logger.info("Firebase initialized successfully!")
-except Exception as e:
-    app_logger.error(f"Error initializing Firebase: {e}")
-    exit(1)
+def _create_firestore_client():
+    import firebase_admin
+    from firebase_admin import credentials, firestore as firestore_module
+    try:
+        cred_json = json.loads(FIREBASE_SERVICE_ACCOUNT_JSON)
+        cred = credentials.Certificate(cred_json)
+        firebase_admin.initialize_app(cred)
+        firestore_client = firestore_module.client()
+        app_logger.info("Firebase initialized successfully!")
+        return firestore_client
+    except Exception as e:
+        app_logger.error(f"Error initializing Firebase: {e}")
+        raise
+
+db = LazyClient("Firestore", _create_firestore_client)
 
 # --- ตั้งค่า OpenAI Client ---
 # ใช้ OpenAI() สำหรับ SDK v1.x.x ขึ้นไป
-client = OpenAI(api_key=OPENAI_API_KEY) 
 # ถ้าคุณใช้ SDK เวอร์ชันเก่า (0.28.1 หรือต่ำกว่า) จะเป็น openai.api_key = OPENAI_API_KEY
 # และเรียกใช้ openai.ChatCompletion.create
+# retry/timeout จัดการเองใน OutboundService (max_retries=0) และใช้ connection pool ขนาดเดียวกับ LINE
+def _create_openai_client():
+    import httpx
+    return openai.OpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        max_retries=0,
+        http_client=openai.DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+        ),
+    )
+
+client = LazyClient("OpenAI", _create_openai_client)
 
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET_KEY
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# --- HTTP client ของ LINE ที่ใช้ connection ซ้ำ (keep-alive) ---
+# RequestsHttpClient ของ SDK เปิด connection ใหม่ทุกครั้ง จึงใช้ requests.Session แทน
+class PooledRequestsHttpClient(RequestsHttpClient):
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+line_bot_api = LazyClient(
+    "LINE",
+    lambda: LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT, timeout=LINE_TIMEOUT, http_client=PooledRequestsHttpClient)
+)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 # --- ข้อมูล Schema สำหรับ AI (อธิบายโครงสร้าง Firestore) ---
@@ -71,12 +257,896 @@ FIRESTORE_SCHEMA_DESCRIPTION = """
 ข้อมูลนี้ใช้สำหรับตอบคำถามทั่วไปเกี่ยวกับสินค้า, ราคา, สต็อก, หมวดหมู่, หรือข้อมูลเฉพาะของสินค้า.
 """
 
+# --- Metrics (Prometheus text format ที่ /metrics) ---
+# เก็บ histogram เวลาของแต่ละขั้นตอน, จำนวน error แยกตามชนิด และจำนวน token ที่ใช้กับ OpenAI
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket counts, sum, count]
+        self._help = {}
+
+    def describe(self, name, metric_type, help_text):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time_stage(self, stage):
+        """จับเวลาขั้นตอน และนับ error ตามชนิดของ exception"""
+        start_time = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.inc("linebot_errors_total", {"stage": stage, "type": type(e).__name__})
+            raise
+        finally:
+            self.observe("linebot_stage_duration_seconds", time.time() - start_time, {"stage": stage})
+
+    def timed(self, stage):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time_stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self, name):
+        """คืนค่า {labels: (count, sum)} ของ histogram ชื่อนี้"""
+        with self._lock:
+            return {labels: (h[2], h[1]) for (metric, labels), h in self._histograms.items() if metric == name}
+
+    def snapshot(self):
+        """ค่าทั้งหมดในรูปที่เขียนเป็น JSON ได้ (ใช้รวม metrics ข้าม worker)"""
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(labels), list(h[0]), h[1], h[2]] for (name, labels), h in self._histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        """บวกค่าจาก snapshot() ของ worker อื่นเข้ามา"""
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, bucket_counts, total, count in snapshot["histograms"]:
+                if len(bucket_counts) != len(self.buckets):
+                    continue
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], bucket_counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self, extra=()):
+        """extra: รายการ (name, labels dict, value) ที่คำนวณตอน scrape เช่น queue depth"""
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+        for name, labels, value in extra:
+            samples.setdefault(name, []).append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms.items():
+            entries = samples.setdefault(name, [])
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                entries.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+            entries.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            entries.append(f"{name}_sum{_format_labels(labels)} {total}")
+            entries.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name in sorted(samples):
+            if name in self._help:
+                metric_type, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRIC_BUCKETS)
+metrics.describe("linebot_stage_duration_seconds", "histogram", "Time spent in each message-handling stage.")
+metrics.describe("linebot_errors_total", "counter", "Errors by stage and exception type.")
+metrics.describe("linebot_openai_tokens_total", "counter", "OpenAI token usage by call and token kind.")
+metrics.describe("linebot_webhook_requests_total", "counter", "Webhook requests by HTTP status.")
+metrics.describe("linebot_cache_requests_total", "counter", "Cache lookups by cache and result.")
+metrics.describe("linebot_events_deduplicated_total", "counter", "Webhook events skipped because they were already processed.")
+metrics.describe("linebot_rate_limited_total", "counter", "Messages rejected by the per-user rate limiter.")
+metrics.describe("linebot_webhook_queue_depth", "gauge", "Webhook jobs waiting in the worker pool queue.")
+metrics.describe("linebot_webhook_in_flight", "gauge", "Webhook jobs currently running.")
+metrics.describe("linebot_catalog_products", "gauge", "Products held in the catalog cache.")
+metrics.describe("linebot_idempotency_keys", "gauge", "Event IDs held by the in-process idempotency store.")
+metrics.describe("linebot_rate_limiter_users", "gauge", "Users tracked by the rate limiter.")
+metrics.describe("linebot_catalog_version", "gauge", "Catalog cache version counter.")
+metrics.describe("linebot_outbound_calls_total", "counter", "Outbound OpenAI/LINE calls by service and result.")
+metrics.describe("linebot_outbound_retries_total", "counter", "Outbound calls retried after a transient error.")
+metrics.describe("linebot_outbound_hedges_total", "counter", "Hedged outbound requests sent and won.")
+metrics.describe("linebot_circuit_state", "gauge", "Circuit breaker state per service (0 closed, 1 half-open, 2 open).")
+metrics.describe("linebot_timeouts_avoided_total", "counter", "Outbound calls that did not wait for a timeout (short-circuited, skipped near the deadline, or won by a hedge).")
+metrics.describe("linebot_fallback_replies_total", "counter", "Replies rendered from local product data because OpenAI was unavailable.")
+
+# --- รวม metrics จากหลาย gunicorn worker ผ่านไฟล์ในโฟลเดอร์ร่วม (METRICS_DIR) ---
+# counter/histogram ของทุก worker (รวมถึง worker ที่ถูก restart ไปแล้ว) ถูกบวกรวมกัน จึงยังเพิ่มขึ้นเรื่อยๆ
+# ส่วนค่าที่คำนวณตอน scrape (queue depth, circuit state ฯลฯ) แยกตาม label pid และแสดงเฉพาะ worker ที่ยังทำงานอยู่
+class MetricsFileStore:
+    FILE_PREFIX = "worker-"
+
+    def __init__(self, registry, directory, interval):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._thread = None
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{self.FILE_PREFIX}{pid}.json")
+
+    def write(self, extra):
+        """เขียน snapshot ของ worker นี้ (เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้ worker อื่นอ่านไฟล์ที่เขียนไม่เสร็จ)"""
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot = self.registry.snapshot()
+        snapshot["extra"] = [[name, labels, value] for name, labels, value in extra]
+        path = self._path(os.getpid())
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(snapshot, file)
+        os.replace(path + ".tmp", path)
+
+    def start(self, extra_func):
+        """เริ่ม thread ที่เขียน snapshot ทุก interval วินาที (เรียกหลัง fork ในแต่ละ worker)"""
+        def flush_loop():
+            while True:
+                try:
+                    self.write(extra_func())
+                except Exception as e:
+                    app_logger.error(f"Failed to write metrics snapshot: {e}")
+                time.sleep(self.interval)
+        self._thread = threading.Thread(target=flush_loop, name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def render(self, extra):
+        """รวม snapshot ของทุก worker (เขียนของตัวเองก่อนเพื่อให้เป็นค่าล่าสุด)"""
+        self.write(extra)
+        merged = Metrics(self.registry.buckets)
+        merged._help = self.registry._help
+        merged_extra = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.startswith(self.FILE_PREFIX) or not filename.endswith(".json"):
+                continue
+            try:
+                pid = int(filename[len(self.FILE_PREFIX):-len(".json")])
+                with open(os.path.join(self.directory, filename), encoding="utf-8") as file:
+                    snapshot = json.load(file)
+            except (ValueError, OSError) as e:
+                app_logger.warning(f"Skipping unreadable metrics snapshot {filename}: {e}")
+                continue
+            merged.merge(snapshot)
+            if self._is_alive(pid):
+                merged_extra += [(name, {**labels, "pid": pid}, value) for name, labels, value in snapshot.get("extra", [])]
+        return merged.render(merged_extra)
+
+metrics_store = MetricsFileStore(metrics, METRICS_DIR, METRICS_FLUSH_INTERVAL) if METRICS_DIR else None
+
+def record_openai_usage(call, usage):
+    """นับ token ที่ใช้กับ OpenAI (usage จาก response หรือ chunk สุดท้ายของ stream)"""
+    if usage is None:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        value = getattr(usage, kind, None)
+        if value:
+            metrics.inc("linebot_openai_tokens_total", {"call": call, "kind": kind.replace('_tokens', '')}, value)
+
+# --- Trace ID ต่อ request (ใส่ใน log เมื่อเปิด LOG_TRACE_IDS) ---
+_trace_id = contextvars.ContextVar('trace_id', default='-')
+_request_trace_id = contextvars.ContextVar('request_trace_id', default='-') # ID ของ request (ก่อนเติม event ID)
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+if LOG_TRACE_IDS:
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(TraceIdFilter())
+        log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:[%(trace_id)s] %(message)s"))
+
+# --- การเรียกบริการภายนอก: deadline ตามอายุ reply token, retry, hedging และ circuit breaker ---
+# ทุกการเรียก OpenAI/LINE ผ่าน OutboundService: timeout ของแต่ละครั้งถูกตัดให้ไม่เกินเวลาที่เหลือก่อน reply token หมดอายุ
+# error ชั่วคราว (timeout, connection, 429, 5xx) จะ retry แบบ exponential backoff + jitter
+# ถ้า error ติดกันเกิน CIRCUIT_FAILURE_THRESHOLD จะตัดวงจร (ไม่เรียกเลย) จนครบ CIRCUIT_RESET_TIMEOUT แล้วจึงลองใหม่ 1 ครั้ง
+_reply_deadline = contextvars.ContextVar('reply_deadline', default=None)
+MIN_CALL_TIMEOUT = 0.5 # ถ้าเวลาที่เหลือน้อยกว่านี้ ไม่เรียกบริการเลย (ตอบด้วยคำตอบสำรองแทน)
+
+def start_reply_deadline(event_timestamp_ms=None):
+    """ตั้ง deadline ของ event ปัจจุบัน: reply token ใช้ได้ประมาณ REPLY_TOKEN_TTL วินาทีนับจาก timestamp ของ event"""
+    now = time.time()
+    started_at = now
+    if event_timestamp_ms:
+        event_time = event_timestamp_ms / 1000.0
+        if now - REPLY_TOKEN_TTL < event_time: # ไม่ใช้ timestamp ที่เก่าผิดปกติ (clock skew / redelivery)
+            started_at = min(event_time, now)
+    _reply_deadline.set(started_at + REPLY_TOKEN_TTL)
+
+def remaining_budget(reserve=0.0):
+    """วินาทีที่เหลือก่อน deadline (หัก reserve ไว้) หรือ None ถ้าไม่มี deadline เช่น warm-up"""
+    deadline = _reply_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - reserve - time.time()
+
+# ไม่ได้เรียกบริการภายนอก เพราะวงจรถูกตัดอยู่ หรือเวลาไม่พอก่อน reply token หมดอายุ
+class OutboundCallError(Exception):
+    pass
+
+class CircuitOpenError(OutboundCallError):
+    pass
+
+class DeadlineExceededError(OutboundCallError):
+    pass
+
+class OutboundTimeoutError(OutboundCallError):
+    pass
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.times_opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                # ให้ผ่านทีละ 1 คำขอเพื่อทดสอบว่าบริการกลับมาแล้วหรือยัง
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                app_logger.info(f"Circuit breaker '{self.name}' closed")
+                self.state = self.CLOSED
+
+    def release_probe(self):
+        """ผลของคำขอไม่บอกสถานะของบริการ (เช่น timeout เพราะเวลาของ reply token ใกล้หมด) ให้คำขอถัดไปทดสอบแทน"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    app_logger.warning(f"Circuit breaker '{self.name}' opened after {self._failures} consecutive failures")
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            retry_in = self._opened_at + self.reset_timeout - time.time() if self.state == self.OPEN else 0
+            return {
+                "state": self.state,
+                "consecutive_failures": self._failures,
+                "times_opened": self.times_opened,
+                "retry_in_seconds": round(max(retry_in, 0), 1),
+            }
+
+class OutboundService:
+    """
+    เรียกบริการภายนอกด้วย func(timeout) ภายใต้ deadline, retry, hedging และ circuit breaker
+    timeouts_avoided นับครั้งที่ไม่ต้องรอจนหมดเวลา: วงจรถูกตัด, เวลาไม่พอจึงไม่เรียก, หรือคำขอ hedge ตอบก่อน
+    """
+    def __init__(self, name, timeout, is_retryable, reserve=0.0, max_retries=OUTBOUND_MAX_RETRIES):
+        self.name = name
+        self.timeout = timeout
+        self.reserve = reserve # เวลาที่ต้องเหลือไว้หลังเรียกเสร็จ (เช่น สำหรับ reply ของ LINE)
+        self.max_retries = max_retries
+        self._is_retryable = is_retryable
+        self.breaker = CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.counters = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0, "timeouts": 0, "deadline_timeouts": 0,
+            "short_circuited": 0, "deadline_skips": 0, "hedges_sent": 0, "hedges_won": 0,
+        }
+
+    def _count(self, key, result=None):
+        with self._lock:
+            self.counters[key] += 1
+        if result:
+            metrics.inc("linebot_outbound_calls_total", {"service": self.name, "result": result})
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS * 2, thread_name_prefix=f"{self.name}-hedge")
+        return self._executor
+
+    def deadline_exceeded(self, what):
+        """นับและคืน DeadlineExceededError (ใช้เมื่อต้องหยุดกลางทาง เช่น ระหว่างอ่าน stream)"""
+        self._count("deadline_skips", "deadline")
+        return DeadlineExceededError(f"{self.name}: not enough time left for {what}")
+
+    def _record_error(self, error, timeout):
+        """นับ error ของคำขอที่ใช้ timeout นี้ คืนค่า True ถ้าเป็น error ชั่วคราวของบริการ (ควร retry/fallback)"""
+        self._count("failures", "error")
+        if not isinstance(error, OutboundCallError) and not self._is_retryable(error):
+            self.breaker.record_success() # บริการตอบกลับมาแล้ว (เช่น 400) ไม่ถือว่าล่ม
+            return False
+        timed_out = isinstance(error, OutboundCallError) or _is_timeout_error(error)
+        if timed_out:
+            self._count("timeouts")
+        if timed_out and timeout < self.timeout:
+            # timeout ถูกตัดให้สั้นลงตามเวลาที่เหลือของ reply token (เช่น รอคิวนาน) ไม่ได้แปลว่าบริการช้าผิดปกติ
+            self._count("deadline_timeouts")
+            self.breaker.release_probe()
+        else:
+            self.breaker.record_failure()
+        return True
+
+    def stream_error(self, error, timeout):
+        """
+        error ระหว่างอ่าน stream (หลัง call() คืนค่าแล้ว) นับแบบเดียวกับ error ของ call()
+        คืนค่า OutboundCallError ถ้าเป็น error ชั่วคราว (เพื่อให้ตอบด้วยคำตอบสำรอง) ไม่เช่นนั้นคืน error เดิม
+        """
+        if isinstance(error, OutboundCallError) or not self._record_error(error, timeout):
+            return error
+        return OutboundCallError(f"{self.name}: stream failed ({type(error).__name__}: {error})")
+
+    def _timeout_for_attempt(self):
+        budget = remaining_budget(self.reserve)
+        if budget is None:
+            return self.timeout
+        if budget < MIN_CALL_TIMEOUT:
+            return None
+        return min(self.timeout, budget)
+
+    def _attempt(self, func, timeout, hedge_delay):
+        if not hedge_delay or hedge_delay >= timeout or self.breaker.state != CircuitBreaker.CLOSED:
+            return func(timeout)
+        executor = self._get_executor()
+        primary = executor.submit(contextvars.copy_context().run, func, timeout)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+        # คำขอแรกช้ากว่า hedge_delay ส่งคำขอที่สองคู่ขนาน แล้วใช้ผลของคำขอที่เสร็จก่อน
+        self._count("hedges_sent")
+        metrics.inc("linebot_outbound_hedges_total", {"service": self.name, "result": "sent"})
+        hedge = executor.submit(contextvars.copy_context().run, func, timeout - hedge_delay)
+        pending = {primary, hedge}
+        give_up_at = time.time() + timeout - hedge_delay
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(give_up_at - time.time(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedges_won")
+                        metrics.inc("linebot_outbound_hedges_total", {"service": self.name, "result": "won"})
+                    return future.result()
+                error = future.exception()
+        if error is not None:
+            raise error
+        # ทั้งสองคำขอใช้เวลาจนหมด timeout: เป็น timeout จริง (นับใน _record_error) ไม่ใช่การข้ามเพราะเวลาไม่พอ
+        raise OutboundTimeoutError(f"{self.name}: hedged call timed out after {timeout:.1f} seconds")
+
+    def call(self, func, hedge_delay=0.0):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            timeout = self._timeout_for_attempt()
+            if timeout is None:
+                if last_error is not None:
+                    raise last_error
+                raise self.deadline_exceeded("call")
+            if not self.breaker.allow():
+                if last_error is not None:
+                    raise last_error
+                self._count("short_circuited", "short_circuited")
+                raise CircuitOpenError(f"{self.name}: circuit breaker is open")
+
+            self._count("calls")
+            try:
+                result = self._attempt(func, timeout, hedge_delay)
+            except Exception as e:
+                if not self._record_error(e, timeout) or isinstance(e, OutboundCallError):
+                    raise
+                last_error = e
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(OUTBOUND_RETRY_MAX_DELAY, OUTBOUND_RETRY_BASE_DELAY * 2 ** attempt))
+                budget = remaining_budget(self.reserve)
+                if budget is not None and budget - delay < MIN_CALL_TIMEOUT:
+                    raise
+                app_logger.warning(f"{self.name} call failed ({type(e).__name__}: {e}), retrying in {delay:.2f} seconds")
+                self._count("retries")
+                metrics.inc("linebot_outbound_retries_total", {"service": self.name})
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self._count("successes", "success")
+            return result
+
+    @property
+    def timeouts_avoided(self):
+        with self._lock:
+            return self.counters["short_circuited"] + self.counters["deadline_skips"] + self.counters["hedges_won"]
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "timeout_seconds": self.timeout,
+            "max_retries": self.max_retries,
+            "circuit": self.breaker.stats(),
+            "timeouts_avoided": counters["short_circuited"] + counters["deadline_skips"] + counters["hedges_won"],
+            **counters,
+        }
+
+def _is_timeout_error(error):
+    # openai.APITimeoutError, httpx.ReadTimeout, requests.exceptions.ConnectTimeout ฯลฯ
+    return "timeout" in type(error).__name__.lower()
+
+def _is_retryable_openai_error(error):
+    import httpx # error ระหว่างอ่าน stream มาจาก httpx โดยตรง (ไม่ได้ห่อเป็น openai.APIError)
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, httpx.TransportError))
+
+def _is_retryable_line_error(error):
+    if isinstance(error, LineBotApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    # ไม่ retry เมื่อ read timeout เพราะ LINE อาจได้รับข้อความแล้ว และ reply token ใช้ได้ครั้งเดียว
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+openai_service = OutboundService("openai", OPENAI_TIMEOUT, _is_retryable_openai_error, reserve=REPLY_RESERVE_SECONDS)
+line_service = OutboundService("line", LINE_TIMEOUT, _is_retryable_line_error)
+OUTBOUND_SERVICES = (openai_service, line_service)
+
+# --- Cache ข้อมูลสินค้า (อัปเดตอัตโนมัติผ่าน Firestore on_snapshot) ---
+# โหลดสินค้าทั้งหมดครั้งเดียว แล้วรับการเปลี่ยนแปลงจาก listener
+# มี index ตาม name และ category เพื่อให้ค้นหาได้โดยไม่ต้องไป Firestore
+# ถ้า listener หลุด จะ reload ทั้ง collection ใหม่เมื่อข้อมูลเก่ากว่า PRODUCT_CACHE_TTL
+# --- เติม field name_lower ให้สินค้าเก่า (ใช้กับ search_by_name และการค้นหาใน /admin) ---
+def backfill_name_lower(products=None):
+    """เขียน name_lower ให้สินค้าที่ยังไม่มีหรือไม่ตรงกับ name ด้วย batched write คืนค่าจำนวนที่แก้ไข
+    products: รายการ (product_id, dict ของ field) ถ้าไม่ระบุจะอ่านทั้ง collection จาก Firestore"""
+    products_ref = db.collection('products')
+    if products is None:
+        products = ((doc.id, doc.to_dict()) for doc in products_ref.stream())
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for product_id, data in products:
+        name = data.get('name')
+        if not isinstance(name, str) or data.get('name_lower') == name.lower():
+            continue
+        batch.set(products_ref.document(product_id), {'name_lower': name.lower()}, merge=True)
+        pending += 1
+        if pending >= FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            updated += pending
+            pending = 0
+            batch = db.batch()
+    if pending:
+        batch.commit()
+        updated += pending
+    if updated:
+        app_logger.info(f"Backfilled name_lower for {updated} products.")
+    return updated
+
+class ProductCatalog:
+    def __init__(self, collection_name, ttl):
+        self.collection_name = collection_name
+        self.ttl = ttl
+        self.version = 0
+        self._products = {} # product_id -> dict ของ field (ไม่มี id)
+        self._by_name = {}
+        self._by_category = {}
+        self._key_versions = {} # ('name' | 'category', ค่า) -> version ล่าสุดที่มีการเปลี่ยนแปลง
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._watch = None
+        self._loaded = False
+        self._last_sync = 0.0
+        self.reloads = 0
+
+    def _index_add(self, product_id, data):
+        self._by_name.setdefault(data.get('name'), set()).add(product_id)
+        self._by_category.setdefault(data.get('category'), set()).add(product_id)
+
+    def _index_remove(self, product_id, data):
+        for index, key in ((self._by_name, data.get('name')), (self._by_category, data.get('category'))):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del index[key]
+
+    def _touch(self, data):
+        # เพิ่ม version และจำไว้ว่า name/category ไหนเปลี่ยนล่าสุดเมื่อไร (ใช้ invalidate cache คำตอบเฉพาะส่วน)
+        self.version += 1
+        self._key_versions[('name', data.get('name'))] = self.version
+        self._key_versions[('category', data.get('category'))] = self.version
+
+    def _put(self, product_id, data):
+        old = self._products.get(product_id)
+        if old == data:
+            return False
+        if old is not None:
+            self._index_remove(product_id, old)
+            self._touch(old)
+        self._products[product_id] = data
+        self._index_add(product_id, data)
+        self._touch(data)
+        return True
+
+    def _delete(self, product_id):
+        old = self._products.pop(product_id, None)
+        if old is not None:
+            self._index_remove(product_id, old)
+            self._touch(old)
+        return old is not None
+
+    def upsert(self, product_id, data, merge=False):
+        """อัปเดต cache ทันทีหลังเขียน Firestore (ไม่ต้องรอ listener)"""
+        with self._lock:
+            if merge and product_id in self._products:
+                data = {**self._products[product_id], **data}
+            self._put(product_id, dict(data))
+
+    def remove(self, product_id):
+        with self._lock:
+            self._delete(product_id)
+
+    def snapshot(self):
+        """สินค้าที่อยู่ใน cache ตอนนี้ โดยไม่ reload จาก Firestore (ใช้ทำคำตอบสำรอง)"""
+        with self._lock:
+            return [dict(data) for data in self._products.values()]
+
+    def dependency_version(self, action, query_params=None):
+        """version ของข้อมูลที่คำตอบของ action นี้ขึ้นอยู่ด้วย"""
+        query_params = query_params or {}
+        with self._lock:
+            if action == "fetch_by_name" and 'name' in query_params:
+                return self._key_versions.get(('name', query_params['name']), 0)
+            if action == "fetch_by_category" and 'category' in query_params:
+                return self._key_versions.get(('category', query_params['category']), 0)
+            if action == "unknown":
+                return 0
+            return self.version
+
+    def reload(self):
+        """โหลดสินค้าทั้งหมดจาก Firestore ใหม่"""
+        start_time = time.time()
+        docs = db.collection(self.collection_name).stream()
+        fresh = {doc.id: doc.to_dict() for doc in docs}
+        # สินค้าเก่าที่ไม่มี name_lower จะค้นหาไม่เจอเมื่อ query ตรงกับ Firestore จึงเติมให้ระหว่าง reload
+        try:
+            backfill_name_lower(fresh.items())
+        except Exception as e:
+            app_logger.error(f"Failed to backfill name_lower: {e}")
+        for data in fresh.values():
+            if isinstance(data.get('name'), str):
+                data['name_lower'] = data['name'].lower()
+        with self._lock:
+            for product_id in [product_id for product_id in self._products if product_id not in fresh]:
+                self._delete(product_id)
+            for product_id, data in fresh.items():
+                self._put(product_id, data)
+            self.reloads += 1
+            self._loaded = True
+            self._last_sync = time.time()
+        app_logger.debug(f"Product catalog reloaded: {len(fresh)} products in {time.time() - start_time:.2f} seconds (version {self.version})")
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    self._delete(doc.id)
+                else: # ADDED, MODIFIED
+                    self._put(doc.id, doc.to_dict())
+            self._last_sync = time.time()
+        app_logger.debug(f"Product catalog received {len(changes)} changes from listener (version {self.version})")
+
+    def _start_listener(self):
+        try:
+            self._watch = db.collection(self.collection_name).on_snapshot(self._on_snapshot)
+        except Exception as e:
+            self._watch = None
+            app_logger.error(f"Failed to start product catalog listener: {e}")
+
+    def listener_active(self):
+        watch = self._watch
+        return watch is not None and getattr(watch, 'is_active', True)
+
+    def _is_fresh(self):
+        return self._loaded and (self.listener_active() or time.time() - self._last_sync < self.ttl)
+
+    def ensure_fresh(self):
+        if self._is_fresh():
+            return
+        # reload ทีละ thread โดยไม่ถือ self._lock ระหว่างอ่าน Firestore (reload() จะสลับข้อมูลใต้ lock เอง)
+        # ถ้าเคยโหลดแล้ว thread อื่นใช้ข้อมูลเดิมไปก่อนระหว่างที่กำลัง reload
+        if not self._refresh_lock.acquire(blocking=not self._loaded):
+            return
+        try:
+            if self._is_fresh():
+                return
+            if self._loaded:
+                app_logger.warning("Product catalog listener is not active, falling back to TTL reload.")
+            self.reload()
+            if not self.listener_active():
+                self._start_listener()
+        finally:
+            self._refresh_lock.release()
+
+    def _collect(self, ids):
+        return [dict(self._products[product_id]) for product_id in ids]
+
+    def all(self, with_id=False):
+        self.ensure_fresh()
+        with self._lock:
+            if with_id:
+                return [{**data, 'id': product_id} for product_id, data in self._products.items()]
+            return self._collect(self._products)
+
+    def by_name(self, name):
+        self.ensure_fresh()
+        with self._lock:
+            return self._collect(self._by_name.get(name, ()))
+
+    def by_category(self, category):
+        self.ensure_fresh()
+        with self._lock:
+            return self._collect(self._by_category.get(category, ()))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": PRODUCT_CACHE_ENABLED,
+                "version": self.version,
+                "products": len(self._products),
+                "listener_active": self.listener_active(),
+                "seconds_since_sync": round(time.time() - self._last_sync, 1) if self._loaded else None,
+                "reloads": self.reloads,
+            }
+
+product_catalog = ProductCatalog('products', PRODUCT_CACHE_TTL)
+
+# --- Query สินค้าแบบกรอง/เรียง/จำกัดจำนวน (ทำงานบน Firestore index) ---
+# แต่ละ action ถูกแปลงเป็น spec (filters, order_by, limit, cursor) แล้วรันได้ทั้งบน Firestore และบน product_catalog
+# composite index ที่ต้องใช้ อยู่ในไฟล์ firestore.indexes.json
+PRODUCT_QUERY_ACTIONS = ["fetch_by_price_range", "fetch_low_stock", "fetch_top_products", "search_by_name"]
+
+def _parse_number(value, cast=float):
+    """แปลงค่าจาก query_params เป็นตัวเลข (รองรับ "30,000") ถ้าไม่ใช่ตัวเลขจะ raise ValueError"""
+    if value is None or value == "":
+        return None
+    number = float(str(value).replace(",", ""))
+    if not math.isfinite(number):
+        raise ValueError(f"not a finite number: {value}")
+    return cast(number)
+
+def build_product_query_spec(action, query_params=None):
+    """แปลง action + query_params เป็น spec ของ query หรือคืนค่า None ถ้า action ไม่รองรับ"""
+    params = query_params or {}
+    try:
+        limit = _parse_number(params.get('limit'), int) or PRODUCT_QUERY_DEFAULT_LIMIT
+    except ValueError:
+        limit = PRODUCT_QUERY_DEFAULT_LIMIT
+    limit = max(1, min(limit, PRODUCT_QUERY_MAX_LIMIT))
+    filters = []
+    # search_by_name ไม่กรองหมวดหมู่ เพราะไม่มี composite index (category, name_lower)
+    if params.get('category') and action != "search_by_name":
+        filters.append(('category', '==', params['category']))
+
+    if action == "fetch_by_price_range":
+        try:
+            min_price = _parse_number(params.get('min_price'))
+            max_price = _parse_number(params.get('max_price'))
+        except ValueError:
+            return None
+        if min_price is not None:
+            filters.append(('price', '>=', min_price))
+        if max_price is not None:
+            filters.append(('price', '<=', max_price))
+        order_by, direction = 'price', params.get('order', 'asc')
+    elif action == "fetch_low_stock":
+        try:
+            max_stock = _parse_number(params.get('max_stock'), int)
+        except ValueError:
+            return None
+        filters.append(('stock', '<=', LOW_STOCK_THRESHOLD if max_stock is None else max_stock))
+        order_by, direction = 'stock', 'asc'
+    elif action == "fetch_top_products":
+        order_by = params.get('sort_by', 'price')
+        if order_by not in ('price', 'stock'):
+            return None
+        direction = params.get('order', 'desc')
+    elif action == "search_by_name":
+        prefix = (params.get('prefix') or params.get('name') or '').strip().lower()
+        if not prefix:
+            return None
+        # ค้นหาแบบ prefix โดยไม่สนตัวพิมพ์เล็ก/ใหญ่ ผ่าน field name_lower
+        filters.append(('name_lower', '>=', prefix))
+        filters.append(('name_lower', '<=', prefix + '\uf8ff'))
+        order_by, direction = 'name_lower', 'asc'
+    else:
+        return None
+
+    return {
+        'filters': filters,
+        'order_by': order_by,
+        'direction': 'desc' if direction == 'desc' else 'asc',
+        'limit': limit,
+        # บอทไม่เก็บประวัติบทสนทนา ข้อความถัดไปจึงขอ "หน้าถัดไป" ไม่ได้ คำถามในแชทอ่านหน้าแรกเสมอ (cursor ใช้ใน /admin)
+        'start_after': None,
+    }
+
+def _run_query_on_firestore(spec):
+    products_ref = db.collection('products')
+    query = products_ref
+    for field, op, value in spec['filters']:
+        query = query.where(field, op, value)
+    direction = firestore.Query.DESCENDING if spec['direction'] == 'desc' else firestore.Query.ASCENDING
+    query = query.order_by(spec['order_by'], direction=direction)
+    if spec['start_after']:
+        cursor_doc = products_ref.document(spec['start_after']).get()
+        if cursor_doc.exists:
+            query = query.start_after(cursor_doc)
+    results = []
+    for doc in query.limit(spec['limit']).stream():
+        product_data = doc.to_dict()
+        product_data['id'] = doc.id
+        results.append(product_data)
+    return results
+
+_QUERY_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+}
+
+def _sort_value(value):
+    """key สำหรับเรียงค่าต่างชนิดกันแบบ Firestore: null < bool < ตัวเลข < string < อื่นๆ"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, str(value))
+
+def _run_query_in_memory(products, spec):
+    matched = []
+    for product in products:
+        product = dict(product)
+        product.setdefault('name_lower', str(product.get('name', '')).lower())
+        try:
+            if all(field in product and _QUERY_OPERATORS[op](product[field], value) for field, op, value in spec['filters']):
+                matched.append(product)
+        except TypeError: # ชนิดข้อมูลไม่ตรงกัน เช่น price เป็น string
+            continue
+    matched = [product for product in matched if spec['order_by'] in product]
+    matched.sort(key=lambda product: (_sort_value(product[spec['order_by']]), product['id']), reverse=spec['direction'] == 'desc')
+    if spec['start_after']:
+        ids = [product['id'] for product in matched]
+        if spec['start_after'] in ids:
+            matched = matched[ids.index(spec['start_after']) + 1:]
+    return matched[:spec['limit']]
+
+def run_product_query(action, query_params=None):
+    """รัน query ตาม action คืนค่ารายการสินค้าพร้อม id หรือ None ถ้า action ไม่รองรับ"""
+    spec = build_product_query_spec(action, query_params)
+    if spec is None:
+        return None
+    if PRODUCT_CACHE_ENABLED:
+        results = _run_query_in_memory(product_catalog.all(with_id=True), spec)
+    else:
+        results = _run_query_on_firestore(spec)
+    app_logger.debug(f"Product query '{action}' returned {len(results)} documents")
+    return results
+
 # --- ฟังก์ชันสำหรับดึงข้อมูลจาก Firestore ตามเจตนา ---
+@metrics.timed("retrieval")
 def get_product_data(action, query_params=None):
     products_ref = db.collection('products')
     result_docs = []
 
     app_logger.debug(f"get_product_data called with action='{action}' and query_params='{query_params}'")
+    if action in PRODUCT_QUERY_ACTIONS:
+        try:
+            results = run_product_query(action, query_params)
+            if results is None:
+                app_logger.debug(f"Action '{action}' has invalid query_params.")
+                return None
+            return [{field: value for field, value in product.items() if field not in ('id', 'name_lower')} for product in results]
+        except Exception as e:
+            app_logger.error(f"Firestore data retrieval error: {e}")
+            return f"เกิดข้อผิดพลาดในการดึงข้อมูลจาก Firebase: {e}"
+
+    if PRODUCT_CACHE_ENABLED:
+        try:
+            if action == "fetch_all_products":
+                result_docs = product_catalog.all()
+            elif action == "fetch_by_name" and query_params and 'name' in query_params:
+                result_docs = product_catalog.by_name(query_params['name'])
+            elif action == "fetch_by_category" and query_params and 'category' in query_params:
+                result_docs = product_catalog.by_category(query_params['category'])
+            else:
+                result_docs = None
+            if result_docs is not None:
+                app_logger.debug(f"Served {len(result_docs)} documents for '{action}' from product catalog cache.")
+                return result_docs
+            result_docs = []
+        except Exception as e:
+            # ถ้า cache ใช้ไม่ได้ ให้ไปอ่านจาก Firestore ตรงๆ แทน
+            app_logger.error(f"Product catalog cache error, falling back to Firestore: {e}")
+            result_docs = []
+
     try:
         if action == "fetch_all_products":
             docs = products_ref.stream()
@@ -103,9 +1173,7 @@ def get_product_data(action, query_params=None):
             app_logger.debug(f"Fetched {len(result_docs)} documents for category '{category_name}'.")
             return result_docs
         
-        # คุณสามารถเพิ่ม action อื่นๆ ได้ที่นี่ เช่น:
-        # - "fetch_low_stock": ดึงสินค้าที่สต็อกเหลือน้อย
-        # - "fetch_expensive_items": ดึงสินค้าที่มีราคาสูง
+        # action ที่กรอง/เรียง/จำกัดจำนวน (fetch_low_stock ฯลฯ) อยู่ใน run_product_query ด้านบน
         
         app_logger.debug(f"Action '{action}' not recognized or missing query_params.")
         return None
@@ -114,161 +1182,1432 @@ def get_product_data(action, query_params=None):
         app_logger.error(f"Firestore data retrieval error: {e}")
         return f"เกิดข้อผิดพลาดในการดึงข้อมูลจาก Firebase: {e}"
 
+# --- Resolver ระบุเจตนาในเครื่อง (fast path ก่อนเรียก OpenAI) ---
+# จับคู่คำถามกับชื่อสินค้า/หมวดหมู่ที่มีอยู่จริงใน product_catalog ด้วย keyword และ fuzzy matching
+# ถ้าความมั่นใจไม่ถึง FAST_INTENT_MIN_CONFIDENCE จะคืนค่า None เพื่อให้ไปใช้ OpenAI แทน
+ALL_PRODUCTS_PHRASES = [
+    "มีสินค้าอะไรบ้าง", "มีอะไรขายบ้าง", "ขายอะไรบ้าง", "สินค้าทั้งหมด", "รายการสินค้า", "มีของอะไรบ้าง",
+    "all products", "list products", "product list", "what do you sell", "what products",
+]
+GREETING_PHRASES = [
+    "สวัสดี", "หวัดดี", "ดีครับ", "ดีค่ะ", "ขอบคุณ", "hello", "hi", "hey", "thank you", "thanks",
+]
+# คำเรียกหมวดหมู่ภาษาไทย -> ชื่อหมวดหมู่ใน Firestore (ใช้เฉพาะเมื่อหมวดหมู่นั้นมีอยู่จริง)
+CATEGORY_ALIASES = {
+    "มือถือ": "Smartphones", "โทรศัพท์": "Smartphones", "สมาร์ทโฟน": "Smartphones",
+    "โน้ตบุ๊ค": "Laptops", "โน๊ตบุ๊ค": "Laptops", "แล็ปท็อป": "Laptops", "แลปท็อป": "Laptops", "notebook": "Laptops",
+    "อุปกรณ์เสริม": "Accessories",
+}
+# คำที่บอกว่าต้องกรอง/เรียงสินค้า ต้องใช้ action ของ query (fetch_top_products ฯลฯ) ไม่ใช่ fetch_by_category
+CHEAPEST_PHRASES = ["ถูกที่สุด", "ถูกสุด", "ราคาต่ำสุด", "cheapest", "lowest price"]
+PRICIEST_PHRASES = ["แพงที่สุด", "แพงสุด", "ราคาสูงสุด", "most expensive", "priciest", "highest price"]
+LOW_STOCK_PHRASES = ["ใกล้หมด", "เหลือน้อย", "สต็อกน้อย", "สต๊อกน้อย", "low stock", "running out", "almost out"]
+MAX_PRICE_PHRASES = ["ไม่เกิน", "ต่ำกว่า", "น้อยกว่า", "ไม่ถึง", "under", "below", "less than", "cheaper than"]
+MIN_PRICE_PHRASES = ["มากกว่า", "สูงกว่า", "ตั้งแต่", "over", "above", "more than", "at least"]
+# คำที่บอกเงื่อนไขแต่แปลงเป็น query เองไม่ได้ (เช่น ไม่มีตัวเลข หรือเป็นช่วงราคา) ให้ OpenAI ตัดสินแทน
+QUERY_HINT_PHRASES = ["แพง", "ราคาถูก", "ถูกๆ", "ระหว่าง", "ช่วงราคา", "cheap", "expensive", "between"]
+
+def _phrase_re(phrases):
+    # คำภาษาอังกฤษต้องเป็นคำเต็ม (under ไม่ตรงกับ understand) ส่วนภาษาไทยไม่มีการเว้นวรรคจึงหาแบบ substring
+    return re.compile("|".join(rf"\b{re.escape(p)}\b" if p.isascii() else re.escape(p) for p in phrases))
+
+_CHEAPEST_RE = _phrase_re(CHEAPEST_PHRASES)
+_PRICIEST_RE = _phrase_re(PRICIEST_PHRASES)
+_LOW_STOCK_RE = _phrase_re(LOW_STOCK_PHRASES)
+_MAX_PRICE_RE = _phrase_re(MAX_PRICE_PHRASES)
+_MIN_PRICE_RE = _phrase_re(MIN_PRICE_PHRASES)
+_QUERY_HINT_RE = _phrase_re(CHEAPEST_PHRASES + PRICIEST_PHRASES + LOW_STOCK_PHRASES
+                            + MAX_PRICE_PHRASES + MIN_PRICE_PHRASES + QUERY_HINT_PHRASES)
+_AMOUNT_RE = re.compile(r"\s*(?:ราคา\s*)?(?:฿\s*)?(\d[\d,]*(?:\.\d+)?)\s*(k|พัน|หมื่น)?")
+_AMOUNT_UNITS = {"k": 1000, "พัน": 1000, "หมื่น": 10000}
+
+def _amount_after(text, phrase_re):
+    """จำนวนเงินที่ตามหลังคำ เช่น "ไม่เกิน 30,000" -> 30000.0 หรือ None"""
+    for phrase in phrase_re.finditer(text):
+        amount = _AMOUNT_RE.match(text, phrase.end())
+        if amount:
+            return float(amount.group(1).replace(",", "")) * _AMOUNT_UNITS.get(amount.group(2), 1)
+    return None
+
+_LATIN_WORD_RE = re.compile(r"[a-z0-9]+")
+_DIGITS_RE = re.compile(r"\d+")
+# ลบเฉพาะเครื่องหมายวรรคตอน (ห้ามใช้ \W เพราะสระ/วรรณยุกต์ภาษาไทยไม่นับเป็น \w)
+_PUNCTUATION_RE = re.compile(r"[!-/:-@\[-`{-~“”‘’…]")
+
+def normalize_text(text):
+    text = _PUNCTUATION_RE.sub(" ", (text or "").lower())
+    return " ".join(text.split())
+
+FUZZY_MAX_CANDIDATES = 50 # จำนวนชื่อสูงสุดที่ส่งให้ difflib ต่อข้อความ (คัดจาก token index ก่อน)
+
+def _match_tokens(text):
+    """token สำหรับคัดชื่อที่น่าจะตรง: คำภาษาอังกฤษ/ตัวเลข และ 3 ตัวอักษรแรก (รองรับพิมพ์ผิดท้ายคำ)"""
+    tokens = set()
+    for word in _LATIN_WORD_RE.findall(text):
+        tokens.add(word)
+        if len(word) > 3:
+            tokens.add(word[:3])
+    return tokens
+
+def _is_greeting(message):
+    """ข้อความสั้นๆ ที่ขึ้นต้นด้วยคำทักทาย คำภาษาอังกฤษต้องเป็นคำเต็ม ("hi" แต่ไม่ใช่ "high", "hint")"""
+    for phrase in GREETING_PHRASES:
+        if not message.startswith(phrase) or len(message) > len(phrase) + 4:
+            continue
+        if not phrase.isascii() or len(message) == len(phrase) or message[len(phrase)] == " ":
+            return True
+    return False
+
+def _contains_name(message, key):
+    """key อยู่ใน message โดยตัวเลขรุ่นไม่ต่อกับตัวเลขอื่น (เช่น "iphone 150" ไม่นับว่ามี "iphone 15")"""
+    start = message.find(key)
+    while start != -1:
+        end = start + len(key)
+        digit_before = key[0].isdigit() and start > 0 and message[start - 1].isdigit()
+        digit_after = key[-1].isdigit() and end < len(message) and message[end].isdigit()
+        if not digit_before and not digit_after:
+            return True
+        start = message.find(key, start + 1)
+    return False
+
+class _ResolverIndex:
+    """snapshot ของชื่อสินค้า/หมวดหมู่ ณ catalog version หนึ่ง (ไม่แก้ไขหลังสร้าง จึงอ่านได้โดยไม่ต้องล็อก)"""
+    def __init__(self, version, products):
+        self.version = version
+        self.names = {} # ชื่อที่ normalize แล้ว -> ชื่อจริง
+        self.categories = {}
+        for product in products:
+            if product.get('name'):
+                self.names[normalize_text(product['name'])] = product['name']
+            if product.get('category'):
+                self.categories[normalize_text(product['category'])] = product['category']
+        self.name_tokens = self._build_token_index(self.names)
+        self.category_tokens = self._build_token_index(self.categories)
+
+    @staticmethod
+    def _build_token_index(keys):
+        index = {}
+        for key in keys:
+            for token in _match_tokens(key):
+                index.setdefault(token, []).append(key)
+        return index
+
+class IntentResolver:
+    def __init__(self, min_confidence):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock() # ใช้กับตัวนับสถิติเท่านั้น การจับคู่ทำนอก lock
+        self._index = None
+        self.hits = 0
+        self.misses = 0
+        self.hits_by_action = {}
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.llm_tokens = 0
+
+    def _get_index(self):
+        # อ่าน version ก่อนดึงสินค้า: ถ้ามีการเปลี่ยนแปลงระหว่างนั้น ครั้งถัดไปจะสร้าง index ใหม่
+        index = self._index
+        version = product_catalog.version
+        if index is not None and index.version == version:
+            return index
+        index = _ResolverIndex(version, product_catalog.all())
+        self._index = index
+        return index
+
+    @staticmethod
+    def _fuzzy_candidates(words, keys, token_index):
+        counts = {}
+        for token in _match_tokens(" ".join(words)):
+            for key in token_index.get(token, ()):
+                counts[key] = counts.get(key, 0) + 1
+        return sorted(counts, key=lambda key: -counts[key])[:FUZZY_MAX_CANDIDATES]
+
+    @staticmethod
+    def _contained_keys(message, keys):
+        """ชื่อทั้งหมดที่อยู่ในข้อความ ไม่นับชื่อที่เป็นส่วนหนึ่งของชื่อที่ยาวกว่า (เช่น "iphone 15" ใน "iphone 15 pro")"""
+        found = [key for key in keys if key and _contains_name(message, key)]
+        return [key for key in found if not any(key != other and key in other for other in found)]
+
+    @classmethod
+    def _best_match(cls, message, keys, token_index):
+        """คืนค่า (key, score) ที่ตรงกับข้อความมากที่สุด โดยดู substring ก่อนแล้วจึง fuzzy"""
+        best_key, best_score = None, 0.0
+        contained = cls._contained_keys(message, keys)
+        if contained:
+            # ชื่อที่ยาวกว่าได้ก่อน เช่น "iphone 15 pro" ก่อน "iphone 15"
+            return max(contained, key=len), 1.0
+        words = _LATIN_WORD_RE.findall(message)
+        for key in cls._fuzzy_candidates(words, keys, token_index):
+            size = len(key.split())
+            for width in {max(1, size - 1), size, size + 1}:
+                for i in range(len(words) - width + 1):
+                    candidate = " ".join(words[i:i + width])
+                    if _DIGITS_RE.findall(candidate) != _DIGITS_RE.findall(key):
+                        continue # ตัวเลขรุ่นต้องตรงกัน เช่น iphone 17 ไม่ใช่ iphone 15
+                    score = difflib.SequenceMatcher(None, candidate, key).ratio()
+                    if score > best_score:
+                        best_key, best_score = key, score
+        return best_key, best_score
+
+    def _match_category(self, message, index):
+        category_key, category_score = self._best_match(message, index.categories, index.category_tokens)
+        for alias, category in CATEGORY_ALIASES.items():
+            alias_key = normalize_text(category)
+            if alias in message and alias_key in index.categories and category_score < 1.0:
+                category_key, category_score = alias_key, 0.95
+        return category_key, category_score
+
+    def _match_query(self, text, message, index):
+        """
+        แปลงคำถามที่มีเงื่อนไขราคา/การเรียง/สต็อก (ถูกที่สุด, ไม่เกิน 30000, ใกล้หมด) เป็น action ของ query
+        คืนค่า None ถ้าไม่มีคำเหล่านี้ หรือ (None, None, 0.0) ถ้ามีแต่แปลงเองไม่ได้
+        """
+        if not _QUERY_HINT_RE.search(text):
+            return None
+        name_key, name_score = self._best_match(message, index.names, index.name_tokens)
+        if name_score >= self.min_confidence:
+            return None, None, 0.0 # ถามเงื่อนไขของสินค้าเฉพาะรุ่น ให้ OpenAI ตัดสิน
+        params = {}
+        category_key, category_score = self._match_category(message, index)
+        if category_score >= self.min_confidence:
+            params["category"] = index.categories[category_key]
+
+        if _CHEAPEST_RE.search(text):
+            return "fetch_top_products", {**params, "sort_by": "price", "order": "asc", "limit": 1}, 0.9
+        if _PRICIEST_RE.search(text):
+            return "fetch_top_products", {**params, "sort_by": "price", "order": "desc", "limit": 1}, 0.9
+        if _LOW_STOCK_RE.search(text):
+            return "fetch_low_stock", params or None, 0.9
+        max_price = _amount_after(text, _MAX_PRICE_RE)
+        min_price = _amount_after(text, _MIN_PRICE_RE)
+        if max_price is not None:
+            params["max_price"] = max_price
+        if min_price is not None:
+            params["min_price"] = min_price
+        if max_price is not None or min_price is not None:
+            return "fetch_by_price_range", params, 0.9
+        return None, None, 0.0
+
+    def _match(self, message, index, text):
+        query = self._match_query(text, message, index)
+        if query is not None:
+            return query
+        # ถามถึงหลายสินค้า/หลายหมวดพร้อมกัน (เช่น เปรียบเทียบ) fetch_by_name ดึงได้ทีละชื่อ จึงให้ OpenAI ตัดสิน
+        if len(self._contained_keys(message, index.names)) > 1 or len(self._contained_keys(message, index.categories)) > 1:
+            return None, None, 0.0
+
+        name_key, name_score = self._best_match(message, index.names, index.name_tokens)
+        if name_score >= self.min_confidence:
+            return "fetch_by_name", {"name": index.names[name_key]}, name_score
+
+        category_key, category_score = self._match_category(message, index)
+        if category_score >= self.min_confidence:
+            return "fetch_by_category", {"category": index.categories[category_key]}, category_score
+
+        if any(phrase in message for phrase in ALL_PRODUCTS_PHRASES):
+            return "fetch_all_products", None, 0.9
+        if _is_greeting(message):
+            return "unknown", None, 0.9
+        return None, None, max(name_score, category_score)
+
+    def resolve(self, user_message):
+        """คืนค่า (action, query_params) ถ้ามั่นใจพอ หรือ None ถ้าควรถาม OpenAI"""
+        message = normalize_text(user_message)
+        try:
+            # ตัวเลขราคา (เช่น 30,000) ต้องอ่านจากข้อความก่อน normalize เพราะ normalize_text ลบเครื่องหมายจุลภาค
+            action, query_params, confidence = self._match(message, self._get_index(), (user_message or "").lower())
+        except Exception as e:
+            app_logger.error(f"Local intent resolver error: {e}")
+            action, confidence = None, 0.0
+        with self._lock:
+            if action is None:
+                self.misses += 1
+                metrics.inc("linebot_cache_requests_total", {"cache": "local_intent", "result": "miss"})
+                app_logger.debug(f"Local intent resolver miss (confidence {confidence:.2f}), falling back to OpenAI.")
+                return None
+            self.hits += 1
+            metrics.inc("linebot_cache_requests_total", {"cache": "local_intent", "result": "hit"})
+            self.hits_by_action[action] = self.hits_by_action.get(action, 0) + 1
+        app_logger.debug(f"Local intent resolver hit: action='{action}', params='{query_params}', confidence {confidence:.2f}")
+        return action, query_params
+
+    def record_llm_call(self, seconds, tokens):
+        with self._lock:
+            self.llm_calls += 1
+            self.llm_seconds += seconds
+            self.llm_tokens += tokens
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            avg_seconds = self.llm_seconds / self.llm_calls if self.llm_calls else 0.0
+            avg_tokens = self.llm_tokens / self.llm_calls if self.llm_calls else 0.0
+            return {
+                "enabled": FAST_INTENT_ENABLED,
+                "min_confidence": self.min_confidence,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "hits_by_action": dict(self.hits_by_action),
+                "openai_intent_calls": self.llm_calls,
+                "avg_openai_intent_seconds": round(avg_seconds, 3),
+                "avg_openai_intent_tokens": round(avg_tokens, 1),
+                # ประมาณการสิ่งที่ประหยัดได้ จากค่าเฉลี่ยของการเรียก OpenAI จริง
+                "estimated_seconds_saved": round(self.hits * avg_seconds, 2),
+                "estimated_tokens_saved": int(self.hits * avg_tokens),
+            }
+
+intent_resolver = IntentResolver(FAST_INTENT_MIN_CONFIDENCE)
+
+# --- ให้ OpenAI GPT ระบุ "เจตนา" และข้อมูลที่ต้องการจากคำถามผู้ใช้ ---
+@metrics.timed("intent_openai")
+def generate_intent_with_openai(user_message):
+    start_openai_intent_time = time.time()
+
+    # Prompt สำหรับ OpenAI GPT
+    # เราใช้ ChatCompletion API ของ OpenAI
+    messages_for_intent = [
+        {"role": "system", "content": f"""
+        คุณคือผู้ช่วย AI ที่เชี่ยวชาญในการทำความเข้าใจคำถามและระบุข้อมูลที่จำเป็นจากฐานข้อมูลสินค้า.
+        ฐานข้อมูลของเรามี Collection 'products' ที่มีโครงสร้างดังนี้:
+        {FIRESTORE_SCHEMA_DESCRIPTION}
+
+        จากคำถามของผู้ใช้ โปรดระบุ "action" ที่เหมาะสมที่สุดเพื่อดึงข้อมูลจากฐานข้อมูล.
+        และระบุ "query_params" ที่จำเป็นสำหรับ action นั้นๆ.
+
+        รูปแบบการตอบกลับต้องเป็น JSON เท่านั้น. ห้ามมีข้อความอื่นใดๆ เพิ่มเติม.
+
+        Possible actions:
+        - "fetch_all_products": เมื่อผู้ใช้ต้องการข้อมูลสินค้าทั้งหมด (ไม่มี query_params)
+        - "fetch_by_name": เมื่อผู้ใช้ถามถึงข้อมูลเฉพาะของสินค้าด้วยชื่อ (query_params: {{"name": "ชื่อสินค้า"}})
+        - "fetch_by_category": เมื่อผู้ใช้ถามถึงสินค้าในหมวดหมู่ใดหมวดหมู่หนึ่ง (query_params: {{"category": "ชื่อหมวดหมู่"}})
+        - "fetch_by_price_range": เมื่อผู้ใช้ถามหาสินค้าในช่วงราคา (query_params: {{"min_price": ตัวเลข, "max_price": ตัวเลข, "category": "ไม่บังคับ", "order": "asc|desc", "limit": ตัวเลข}})
+        - "fetch_low_stock": เมื่อผู้ใช้ถามถึงสินค้าที่ใกล้หมด/สต็อกเหลือน้อย (query_params: {{"max_stock": ตัวเลข (ไม่บังคับ), "category": "ไม่บังคับ"}})
+        - "fetch_top_products": เมื่อผู้ใช้ถามหาสินค้าที่ถูกที่สุด/แพงที่สุด/สต็อกมากที่สุด (query_params: {{"sort_by": "price|stock", "order": "asc|desc", "limit": ตัวเลข, "category": "ไม่บังคับ"}})
+        - "search_by_name": เมื่อผู้ใช้พิมพ์ชื่อสินค้าไม่ครบหรือไม่แน่ใจชื่อเต็ม (query_params: {{"prefix": "คำขึ้นต้นของชื่อสินค้า"}})
+        - "unknown": เมื่อไม่สามารถระบุ action ได้ (ไม่มี query_params)
+
+        ตัวอย่างการตอบกลับ:
+        - สำหรับ "มีสินค้าอะไรบ้าง": {{"action": "fetch_all_products"}}
+        - สำหรับ "ราคา iPhone 15 เท่าไหร่": {{"action": "fetch_by_name", "query_params": {{"name": "iPhone 15"}}}}
+        - สำหรับ "สินค้าหมวด Laptops มีอะไรบ้าง": {{"action": "fetch_by_category", "query_params": {{"category": "Laptops"}}}}
+        - สำหรับ "มีสินค้าราคาไม่เกิน 10,000 บาทไหม": {{"action": "fetch_by_price_range", "query_params": {{"max_price": 10000}}}}
+        - สำหรับ "laptop ที่ถูกที่สุด": {{"action": "fetch_top_products", "query_params": {{"sort_by": "price", "order": "asc", "limit": 1, "category": "Laptops"}}}}
+        - สำหรับ "สินค้าอะไรใกล้หมดบ้าง": {{"action": "fetch_low_stock"}}
+        - สำหรับ "สวัสดี": {{"action": "unknown"}}
+        """},
+        {"role": "user", "content": user_message}
+    ]
+
+    intent_response_openai = openai_service.call(
+        lambda timeout: client.chat.completions.create(
+            model="gpt-3.5-turbo", # สามารถลองใช้ "gpt-4o" หรือรุ่นอื่นที่คุณมีสิทธิ์เข้าถึง
+            messages=messages_for_intent,
+            response_format={"type": "json_object"}, # สำคัญมากเพื่อให้ GPT ตอบกลับมาเป็น JSON
+            timeout=timeout
+        ),
+        hedge_delay=INTENT_HEDGE_DELAY
+    )
+    intent_json_str = intent_response_openai.choices[0].message.content.strip()
+    intent_elapsed = time.time() - start_openai_intent_time
+    app_logger.debug(f"Time for OpenAI Intent generation: {intent_elapsed:.2f} seconds")
+    usage = getattr(intent_response_openai, 'usage', None)
+    intent_resolver.record_llm_call(intent_elapsed, getattr(usage, 'total_tokens', 0) or 0)
+    record_openai_usage("intent", usage)
+    app_logger.debug(f"OpenAI Intent JSON: {intent_json_str}")
+
+    action = "unknown"
+    query_params = None
+    try:
+        intent_data = json.loads(intent_json_str)
+        action = intent_data.get('action')
+        query_params = intent_data.get('query_params')
+        app_logger.debug(f"Parsed action: '{action}', params: '{query_params}'")
+    except json.JSONDecodeError:
+        app_logger.error(f"Failed to parse JSON from OpenAI: {intent_json_str}")
+        # action ยังคงเป็น "unknown" ตามค่าเริ่มต้น
+
+    return action, query_params
+
+
+# --- สร้าง Context ข้อมูลสินค้าสำหรับ Prompt ภายใต้งบ Token ---
+# ตัด indentation และ field ที่ไม่ใช้ เรียงสินค้าตามความเกี่ยวข้องกับคำถาม แล้วใส่จนเต็ม CONTEXT_TOKEN_BUDGET
+# สินค้าที่เหลือจะถูกสรุปเป็นรายหมวดหมู่ (จำนวน + ช่วงราคา) เพื่อไม่ให้ prompt โตตามขนาด catalog
+CONTEXT_PRODUCT_FIELDS = ['name', 'price', 'stock', 'category']
+
+def estimate_tokens(text):
+    """ประมาณจำนวน token แบบคร่าวๆ: ตัวอักษรอังกฤษ ~4 ตัวต่อ token, ตัวอักษรไทย/อื่นๆ ~1 ตัวต่อ token"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+def _product_relevance(product, message):
+    score = 0.0
+    name = normalize_text(str(product.get('name', '')))
+    category = normalize_text(str(product.get('category', '')))
+    if name and name in message:
+        score += 2.0
+    elif name and any(word in message for word in name.split() if len(word) > 2):
+        score += 1.0
+    if category and category in message:
+        score += 1.0
+    if (product.get('stock') or 0) > 0:
+        score += 0.5
+    return score
+
+def _format_price(price):
+    try:
+        return f"{float(price):,.0f}"
+    except (TypeError, ValueError):
+        return str(price)
+
+def _summary_lines(products, token_budget):
+    """สรุปสินค้าที่แสดงไม่ครบเป็นรายหมวดหมู่ หมวดที่เกินงบ token จะรวมเป็นบรรทัดเดียว"""
+    summary = {}
+    for product in products:
+        entry = summary.setdefault(product.get('category', 'อื่นๆ'), {'count': 0, 'prices': []})
+        entry['count'] += 1
+        if isinstance(product.get('price'), (int, float)):
+            entry['prices'].append(product['price'])
+    entries = sorted(summary.items(), key=lambda item: -item[1]['count'])
+
+    def rest_line(rest):
+        return f"- หมวดหมู่อื่นอีก {len(rest)} หมวด: {sum(entry['count'] for _, entry in rest)} รายการ"
+
+    lines = [f"และสินค้าอื่นอีก {len(products)} รายการ (แสดงเป็นสรุปรายหมวดหมู่):"]
+    used_tokens = estimate_tokens(lines[0])
+    for i, (category, entry) in enumerate(entries):
+        price_range = f" ราคา {_format_price(min(entry['prices']))}-{_format_price(max(entry['prices']))} บาท" if entry['prices'] else ""
+        line = f"- {category}: {entry['count']} รายการ{price_range}"
+        rest = entries[i + 1:]
+        if used_tokens + estimate_tokens(line) + (estimate_tokens(rest_line(rest)) if rest else 0) > token_budget:
+            lines.append(rest_line(entries[i:]))
+            break
+        lines.append(line)
+        used_tokens += estimate_tokens(line)
+    return lines
+
+def build_product_context(retrieved_data, user_message, token_budget=None, action=None):
+    """คืนค่า (ข้อความ context, จำนวน token โดยประมาณ)"""
+    if not retrieved_data:
+        return "ไม่พบข้อมูลที่เกี่ยวข้อง", 0
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    message = normalize_text(user_message)
+    products = [{field: product[field] for field in CONTEXT_PRODUCT_FIELDS if field in product} for product in retrieved_data]
+    # query action เรียงผลมาแล้วตามคำถาม (เช่น สต็อกน้อยสุดก่อน) จึงไม่จัดลำดับใหม่ตามความเกี่ยวข้อง
+    ranked = products if action in PRODUCT_QUERY_ACTIONS else sorted(products, key=lambda product: -_product_relevance(product, message))
+
+    lines = []
+    line_tokens = []
+    remaining = []
+    for product in ranked:
+        line = json.dumps(product, ensure_ascii=False, separators=(',', ':'))
+        tokens = estimate_tokens(line)
+        if remaining or sum(line_tokens) + tokens > token_budget:
+            remaining.append(product)
+            continue
+        lines.append(line)
+        line_tokens.append(tokens)
+
+    if remaining:
+        # บรรทัดสรุปนับรวมในงบด้วย: ถ้าไม่พอ ย้ายสินค้าท้ายรายการไปอยู่ในสรุปแทน
+        summary = _summary_lines(remaining, token_budget - sum(line_tokens))
+        while lines and sum(line_tokens) + estimate_tokens("\n".join(summary)) > token_budget:
+            lines.pop()
+            line_tokens.pop()
+            remaining.insert(0, ranked[len(lines)])
+            summary = _summary_lines(remaining, token_budget - sum(line_tokens))
+        lines += summary
+
+    context = "\n".join(lines)
+    context_tokens = estimate_tokens(context)
+    prompt_tokens.record('context_estimated', context_tokens)
+    app_logger.debug(f"Built product context: {len(ranked) - len(remaining)} products in full, {len(remaining)} summarized, ~{context_tokens} tokens")
+    return context, context_tokens
+
+# --- ให้ OpenAI GPT สังเคราะห์คำตอบจากข้อมูลที่ดึงมา ---
+@metrics.timed("answer")
+def generate_answer_with_openai(user_message, retrieved_data, action=None):
+    start_openai_answer_time = time.time()
+    product_context, _ = build_product_context(retrieved_data, user_message, action=action)
+
+    messages_for_answer = [
+        {"role": "system", "content": f"""
+        คุณคือผู้ช่วย AI ที่เป็นมิตรและเป็นประโยชน์.
+        ผู้ใช้ถามคำถาม: "{user_message}"
+        นี่คือข้อมูลที่เรามีจากฐานข้อมูลสินค้า (Firebase Firestore):
+        {product_context}
+
+        โปรดตอบคำถามของผู้ใช้ด้วยภาษาที่เป็นธรรมชาติและเป็นประโยชน์อย่างยิ่ง โดยอ้างอิงจากข้อมูลที่ให้มาเท่านั้น.
+        หากข้อมูลที่ให้มาไม่เพียงพอที่จะตอบคำถามได้ตรงๆ ให้ตอบกลับอย่างสุภาพและบอกว่าเรามีข้อมูลอะไรบ้างที่เกี่ยวข้องแทน.
+        ห้ามสร้างข้อมูลเอง.
+
+        ตัวอย่างการตอบ:
+        - ถ้าถามราคา iPhone 15 และมีข้อมูล: "iPhone 15 มีราคา 35,000 บาทค่ะ"
+        - ถ้าถามสินค้าหมวด Laptops และมีข้อมูล: "สินค้าในหมวด Laptops ได้แก่ MacBook Air M3 (ราคา 45,000 บาท) และ Dell XPS 15 (ราคา 55,000 บาท) ค่ะ"
+        - ถ้าถามเรื่องสต็อก: "สินค้า iPhone 15 มีสต็อก 100 ชิ้นค่ะ"
+        - ถ้าถามสิ่งที่ข้อมูลไม่มี: "ขออภัยค่ะ ไม่พบข้อมูลเกี่ยวกับเรื่องนั้นในฐานข้อมูลของเราในขณะนี้"
+        """},
+        {"role": "user", "content": user_message}
+    ]
+
+    final_answer_openai = openai_service.call(
+        lambda timeout: client.chat.completions.create(
+            model="gpt-3.5-turbo", # สามารถลองใช้ "gpt-4o" หรือรุ่นอื่นที่คุณมีสิทธิ์เข้าถึง
+            messages=messages_for_answer,
+            timeout=timeout
+        )
+    )
+    reply_message = final_answer_openai.choices[0].message.content.strip()
+    usage = getattr(final_answer_openai, 'usage', None)
+    record_openai_usage("answer", usage)
+    if getattr(usage, 'prompt_tokens', None):
+        prompt_tokens.record('answer_prompt', usage.prompt_tokens)
+    app_logger.debug(f"Time for OpenAI Answer generation: {time.time() - start_openai_answer_time:.2f} seconds")
+    app_logger.debug(f"Final reply message to LINE: '{reply_message}'")
+    return reply_message
+
+
+# --- Pipeline แบบ Tool Calling (ANSWER_PIPELINE=tools) ---
+# GPT ได้รับ get_product_data เป็น tool แล้วตอบในบทสนทนาเดียวกัน (stream token กลับมา)
+# ถ้า resolver ในเครื่องระบุเจตนาได้แล้ว จะใส่ผลลัพธ์ของ tool ให้เลย ทำให้เหลือการเรียก OpenAI ครั้งเดียว
+PRODUCT_DATA_ACTIONS = ["fetch_all_products", "fetch_by_name", "fetch_by_category"] + PRODUCT_QUERY_ACTIONS
+
+PRODUCT_DATA_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_product_data",
+            "description": "ดึงข้อมูลสินค้าจากฐานข้อมูล Firestore (Collection 'products')",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "enum": PRODUCT_DATA_ACTIONS},
+                    "query_params": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string", "description": "ชื่อสินค้า สำหรับ fetch_by_name"},
+                            "category": {"type": "string", "description": "ชื่อหมวดหมู่ สำหรับ fetch_by_category (หรือใช้กรอง action อื่น)"},
+                            "min_price": {"type": "number"},
+                            "max_price": {"type": "number"},
+                            "max_stock": {"type": "integer", "description": "เกณฑ์สต็อกเหลือน้อย สำหรับ fetch_low_stock"},
+                            "sort_by": {"type": "string", "enum": ["price", "stock"]},
+                            "order": {"type": "string", "enum": ["asc", "desc"]},
+                            "limit": {"type": "integer"},
+                            "prefix": {"type": "string", "description": "คำขึ้นต้นของชื่อสินค้า สำหรับ search_by_name"},
+                        },
+                    },
+                },
+                "required": ["action"],
+            },
+        },
+    }
+]
+
+TOOLS_SYSTEM_PROMPT = f"""
+คุณคือผู้ช่วย AI ที่เป็นมิตรและเป็นประโยชน์ สำหรับร้านค้าของเรา.
+{FIRESTORE_SCHEMA_DESCRIPTION}
+ถ้าคำถามเกี่ยวกับสินค้า ให้เรียก tool get_product_data เพื่อดึงข้อมูลก่อนตอบ.
+ตอบคำถามด้วยภาษาที่เป็นธรรมชาติ โดยอ้างอิงจากข้อมูลที่ได้จาก tool เท่านั้น ห้ามสร้างข้อมูลเอง.
+หากข้อมูลไม่เพียงพอ ให้ตอบอย่างสุภาพและบอกว่าเรามีข้อมูลอะไรบ้างที่เกี่ยวข้องแทน.
+ตัวอย่างการตอบ: "iPhone 15 มีราคา 35,000 บาทค่ะ"
+"""
+
+def _read_stream(stream, timeout):
+    """อ่าน chunk จาก stream ภายใต้ deadline โดยส่ง error ระหว่างอ่าน (เช่น httpx.ReadTimeout) ให้ openai_service นับด้วย"""
+    chunks = iter(stream)
+    while True:
+        budget = remaining_budget(REPLY_RESERVE_SECONDS)
+        if budget is not None and budget < 0: # หยุดอ่าน stream เพื่อให้ยังตอบทันก่อน reply token หมดอายุ
+            stream.close()
+            raise openai_service.deadline_exceeded("streamed answer")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except Exception as e:
+            error = openai_service.stream_error(e, timeout)
+            if error is e:
+                raise
+            raise error from e
+        yield chunk
+
+def stream_chat_completion(messages, **kwargs):
+    """เรียก chat completion แบบ stream แล้วรวม token เป็น (content, tool_calls)"""
+    start_time = time.time()
+    first_token_time = None
+    content_parts = []
+    tool_calls = {}
+    request_timeouts = []
+
+    def create_stream(timeout):
+        request_timeouts.append(timeout)
+        return client.chat.completions.create(
+            model="gpt-3.5-turbo", # สามารถลองใช้ "gpt-4o" หรือรุ่นอื่นที่คุณมีสิทธิ์เข้าถึง
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+            **kwargs
+        )
+
+    stream = openai_service.call(create_stream)
+    for chunk in _read_stream(stream, request_timeouts[-1]):
+        usage = getattr(chunk, 'usage', None)
+        record_openai_usage("answer_stream", usage)
+        if getattr(usage, 'prompt_tokens', None):
+            prompt_tokens.record('answer_prompt', usage.prompt_tokens)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if first_token_time is None:
+            first_token_time = time.time()
+        if delta.content:
+            content_parts.append(delta.content)
+        for tool_call in delta.tool_calls or []:
+            entry = tool_calls.setdefault(tool_call.index, {"id": None, "name": "", "arguments": ""})
+            if tool_call.id:
+                entry["id"] = tool_call.id
+            if tool_call.function and tool_call.function.name:
+                entry["name"] += tool_call.function.name
+            if tool_call.function and tool_call.function.arguments:
+                entry["arguments"] += tool_call.function.arguments
+    if first_token_time is not None:
+        app_logger.debug(f"OpenAI stream: first token after {first_token_time - start_time:.2f} seconds, complete after {time.time() - start_time:.2f} seconds")
+    return "".join(content_parts).strip(), [tool_calls[i] for i in sorted(tool_calls)]
+
+def _tool_call_messages(call_id, action, query_params, retrieved_data, user_message):
+    arguments = {"action": action}
+    if query_params:
+        arguments["query_params"] = query_params
+    return [
+        {"role": "assistant", "content": None, "tool_calls": [{
+            "id": call_id,
+            "type": "function",
+            "function": {"name": "get_product_data", "arguments": json.dumps(arguments, ensure_ascii=False)},
+        }]},
+        {"role": "tool", "tool_call_id": call_id,
+         "content": build_product_context(retrieved_data, user_message, action=action)[0]},
+    ]
+
+# error จาก Firestore ระหว่างสร้างคำตอบ (ข้อความใน exception คือข้อความที่จะตอบผู้ใช้)
+# ใช้ exception แทนการคืนค่า string เพื่อไม่ให้ข้อความ error ถูกเก็บใน answer_cache
+class ProductDataError(Exception):
+    pass
+
+@metrics.timed("answer")
+def generate_answer_with_tools(user_message, local_intent=None):
+    start_openai_answer_time = time.time()
+    messages = [
+        {"role": "system", "content": TOOLS_SYSTEM_PROMPT},
+        {"role": "user", "content": user_message},
+    ]
+
+    if local_intent is not None and local_intent[0] != "unknown":
+        # resolver ในเครื่องระบุเจตนาได้แล้ว ดึงข้อมูลเองและส่งผลลัพธ์ของ tool ไปพร้อมกันเลย
+        action, query_params = local_intent
+        retrieved_data = get_product_data(action, query_params)
+        if isinstance(retrieved_data, str): # error จาก Firestore
+            raise ProductDataError(retrieved_data)
+        messages += _tool_call_messages("call_local_intent", action, query_params, retrieved_data, user_message)
+        reply_message, _ = stream_chat_completion(messages, tools=PRODUCT_DATA_TOOLS, tool_choice="none")
+    else:
+        reply_message, tool_calls = stream_chat_completion(messages, tools=PRODUCT_DATA_TOOLS, tool_choice="auto")
+        if tool_calls:
+            for tool_call in tool_calls:
+                try:
+                    arguments = json.loads(tool_call["arguments"] or "{}")
+                except json.JSONDecodeError:
+                    app_logger.error(f"Failed to parse tool arguments from OpenAI: {tool_call['arguments']}")
+                    arguments = {}
+                action = arguments.get("action", "unknown")
+                query_params = arguments.get("query_params")
+                app_logger.debug(f"OpenAI tool call: action='{action}', params='{query_params}'")
+                retrieved_data = get_product_data(action, query_params) if action in PRODUCT_DATA_ACTIONS else None
+                if isinstance(retrieved_data, str): # error จาก Firestore
+                    raise ProductDataError(retrieved_data)
+                messages += _tool_call_messages(tool_call["id"], action, query_params, retrieved_data, user_message)
+            reply_message, _ = stream_chat_completion(messages, tools=PRODUCT_DATA_TOOLS, tool_choice="none")
+
+    app_logger.debug(f"Time for OpenAI Answer generation (tools pipeline): {time.time() - start_openai_answer_time:.2f} seconds")
+    app_logger.debug(f"Final reply message to LINE: '{reply_message}'")
+    return reply_message
+
+# --- คำตอบสำรองจากข้อมูลสินค้าในเครื่อง (เมื่อเรียก OpenAI ไม่ได้หรือไม่ทันเวลา) ---
+# ใช้ข้อมูลที่ดึงจาก Firestore ใน request นี้ ถ้าไม่มีจึงใช้ snapshot ล่าสุดของ product_catalog
+FALLBACK_INTRO = "ขออภัยค่ะ ขณะนี้ระบบ AI ไม่สามารถตอบได้ จึงขอแสดงข้อมูลสินค้าที่เกี่ยวข้องไว้ก่อนนะคะ"
+
+def render_fallback_answer(user_message, products):
+    """สร้างคำตอบจาก template คืนค่า None ถ้าไม่มีข้อมูลสินค้าให้แสดง"""
+    if not products:
+        return None
+    message = normalize_text(user_message)
+    ranked = sorted(products, key=lambda product: -_product_relevance(product, message))[:FALLBACK_MAX_PRODUCTS]
+    lines = [FALLBACK_INTRO]
+    for product in ranked:
+        lines.append(f"- {product.get('name', '-')} ราคา {_format_price(product.get('price'))} บาท (คงเหลือ {product.get('stock', '-')} ชิ้น)")
+    if len(products) > len(ranked):
+        lines.append(f"และสินค้าอื่นอีก {len(products) - len(ranked)} รายการ")
+    return "\n".join(lines)
+
+# --- เก็บค่าตัวอย่างล่าสุด (เวลาตอบกลับ, จำนวน token) เพื่อดู p50/p95 ---
+class SampleWindow:
+    def __init__(self, size=1000):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.size)).append(seconds)
+
+    @staticmethod
+    def _percentile(sorted_samples, pct):
+        index = min(len(sorted_samples) - 1, int(round(pct / 100 * (len(sorted_samples) - 1))))
+        return sorted_samples[index]
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for key, samples in self._samples.items():
+                ordered = sorted(samples)
+                result[key] = {
+                    "count": len(ordered),
+                    "p50": round(self._percentile(ordered, 50), 3),
+                    "p95": round(self._percentile(ordered, 95), 3),
+                    "max": round(ordered[-1], 3),
+                }
+            return result
+
+pipeline_latency = SampleWindow()
+prompt_tokens = SampleWindow()
+
+# --- Cache คำตอบ (LRU + TTL) พร้อมรวมคำถามที่ซ้ำกันระหว่างประมวลผล ---
+# key คือคำถามที่ normalize แล้ว + action + query_params
+# แต่ละ entry เก็บ version ของข้อมูลที่คำตอบขึ้นอยู่ด้วย ถ้า version เปลี่ยน entry นั้นจะถือว่าหมดอายุ
+# ถ้ามีคำถามเดียวกันกำลังถูกประมวลผลอยู่ request อื่นจะรอผลลัพธ์เดียวกันแทนการเรียก OpenAI ซ้ำ
+class ResponseCache:
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (version, value, expires_at)
+        self._in_flight = {} # key -> [threading.Event, value, exception]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _lookup(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        entry_version, value, expires_at = entry
+        if entry_version != version or expires_at < time.time():
+            del self._entries[key]
+            self.invalidations += 1
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key, version, value):
+        self._entries[key] = (version, value, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, key, version, compute):
+        """คืนค่าจาก cache ถ้ามี ไม่เช่นนั้นเรียก compute() (ค่าว่างจะไม่ถูกเก็บ)"""
+        with self._lock:
+            found, value = self._lookup(key, version)
+            if found:
+                self.hits += 1
+                metrics.inc("linebot_cache_requests_total", {"cache": self.name.lower(), "result": "hit"})
+                app_logger.debug(f"{self.name} cache hit for {key}")
+                return value
+            waiter = self._in_flight.get(key)
+            if waiter is None:
+                self.misses += 1
+                metrics.inc("linebot_cache_requests_total", {"cache": self.name.lower(), "result": "miss"})
+                waiter = [threading.Event(), None, None]
+                self._in_flight[key] = waiter
+                leader = True
+            else:
+                self.coalesced += 1
+                metrics.inc("linebot_cache_requests_total", {"cache": self.name.lower(), "result": "coalesced"})
+                leader = False
+
+        if not leader:
+            app_logger.debug(f"{self.name} cache: waiting for in-flight request for {key}")
+            waiter[0].wait()
+            if waiter[2] is not None:
+                raise waiter[2]
+            return waiter[1]
+
+        try:
+            value = compute()
+            waiter[1] = value
+            return value
+        except Exception as e:
+            waiter[2] = e
+            raise
+        finally:
+            with self._lock:
+                if waiter[2] is None and waiter[1]:
+                    self._store(key, version, waiter[1])
+                del self._in_flight[key]
+            waiter[0].set()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": round((self.hits + self.coalesced) / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+intent_cache = ResponseCache("Intent", RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+answer_cache = ResponseCache("Answer", RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def answer_cache_key(user_message, action, query_params):
+    return (normalize_text(user_message), action, json.dumps(query_params, sort_keys=True, ensure_ascii=False) if query_params else None)
+
+def answer_cache_active():
+    """cache คำตอบได้เฉพาะเมื่อ listener ของ catalog ทำงานอยู่
+    (version ของ catalog จึงเปลี่ยนตามการแก้ไขจากทุก worker ไม่ใช่เฉพาะที่แก้ใน process นี้)"""
+    return RESPONSE_CACHE_ENABLED and PRODUCT_CACHE_ENABLED and product_catalog.listener_active()
+
+# --- กันการประมวลผล Webhook ซ้ำ (LINE ส่ง event เดิมมาใหม่เมื่อ /callback ตอบช้า) ---
+# ใช้ webhookEventId (หรือ message ID) เป็น key เก็บในหน่วยความจำแบบ TTL + LRU
+# ถ้ามีหลาย instance ให้ตั้ง IDEMPOTENCY_BACKEND=firestore เพื่อใช้ collection กลางร่วมกัน
+class MemoryIdempotencyStore:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._seen = OrderedDict() # key -> expires_at
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """คืนค่า True ถ้า key นี้ยังไม่เคยเห็น (และจองไว้แล้ว)"""
+        now = time.time()
+        with self._lock:
+            expires_at = self._seen.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._seen[key] = now + self.ttl
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            return True
+
+    def __len__(self):
+        return len(self._seen)
+
+class FirestoreIdempotencyStore:
+    """ใช้ document.create() ซึ่งจะล้มเหลวถ้า document มีอยู่แล้ว
+    ตั้ง TTL policy ของ Firestore บน field expires_at เพื่อลบ document เก่าอัตโนมัติ"""
+
+    def __init__(self, collection_name, ttl):
+        self.collection_name = collection_name
+        self.ttl = ttl
+
+    def claim(self, key):
+        from google.api_core.exceptions import AlreadyExists
+        from datetime import datetime, timedelta, timezone
+        try:
+            db.collection(self.collection_name).document(key).create({
+                'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+            })
+            return True
+        except AlreadyExists:
+            return False
+
+IDEMPOTENCY_BACKENDS = {
+    "firestore": lambda: FirestoreIdempotencyStore("webhook_events", IDEMPOTENCY_TTL),
+}
+
+# ค่าที่พิมพ์ผิดจะทำให้ไม่มีการกันซ้ำข้าม instance โดยไม่รู้ตัว จึงหยุดตั้งแต่ตอนเริ่ม
+if IDEMPOTENCY_BACKEND != "memory" and IDEMPOTENCY_BACKEND not in IDEMPOTENCY_BACKENDS:
+    raise ValueError(f"Unknown IDEMPOTENCY_BACKEND '{IDEMPOTENCY_BACKEND}' (expected 'memory' or {', '.join(repr(name) for name in IDEMPOTENCY_BACKENDS)}).")
+
+local_event_store = MemoryIdempotencyStore(IDEMPOTENCY_MAX_EVENTS, IDEMPOTENCY_TTL)
+shared_event_store = IDEMPOTENCY_BACKENDS[IDEMPOTENCY_BACKEND]() if IDEMPOTENCY_BACKEND in IDEMPOTENCY_BACKENDS else None
+
+def _event_key(event):
+    return getattr(event, 'webhook_event_id', None) or getattr(getattr(event, 'message', None), 'id', None)
+
+def claim_event(event):
+    """คืนค่า False ถ้า event นี้เคยถูกประมวลผลแล้วใน process นี้"""
+    key = _event_key(event)
+    return not key or local_event_store.claim(key)
+
+def claim_event_shared(event):
+    """คืนค่า False ถ้า instance อื่นประมวลผล event นี้ไปแล้ว (เรียกหลัง rate limit เพื่อไม่ให้ข้อความที่ถูกจำกัดต้องเขียน Firestore)"""
+    key = _event_key(event)
+    if not key or shared_event_store is None:
+        return True
+    try:
+        return shared_event_store.claim(key)
+    except Exception as e:
+        # backend กลางใช้ไม่ได้ ให้ประมวลผลต่อ (ดีกว่าไม่ตอบผู้ใช้)
+        app_logger.error(f"Shared idempotency store error: {e}")
+        return True
+
+# --- จำกัดอัตราข้อความต่อผู้ใช้ (token bucket) ---
+# แต่ละผู้ใช้มี bucket จุ RATE_LIMIT_BURST token เติม RATE_LIMIT_PER_MINUTE token ต่อนาที
+# เก็บ bucket แบบ LRU จำกัดจำนวน (bucket ที่ถูกลบออกจะเริ่มใหม่แบบเต็ม ซึ่งเหมือนกับผู้ใช้ที่ไม่ได้ส่งข้อความนานแล้ว)
+class UserRateLimiter:
+    def __init__(self, per_minute, burst, max_users):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict() # user_id -> [tokens, last_refill, แจ้งผู้ใช้แล้วหรือยังในช่วงที่ถูกจำกัด]
+        self._lock = threading.Lock()
+
+    def allow(self, user_id):
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = [float(self.burst), now, False]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            self._buckets.move_to_end(user_id)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+            if bucket[0] < 1.0:
+                return False
+            bucket[0] -= 1.0
+            bucket[2] = False
+            return True
+
+    def should_notify(self, user_id):
+        """คืนค่า True ครั้งเดียวต่อช่วงที่ผู้ใช้ถูกจำกัด (จนกว่าจะส่งข้อความผ่านอีกครั้ง) เพื่อไม่ตอบทุกข้อความที่ถูกตัด"""
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None or bucket[2]:
+                return False
+            bucket[2] = True
+            return True
+
+    def __len__(self):
+        return len(self._buckets)
+
+user_rate_limiter = UserRateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_USERS)
+
+# --- Worker Pool สำหรับประมวลผล Webhook แบบ Asynchronous ---
+# executor ถูกสร้างตอนใช้งานครั้งแรก เพื่อไม่ให้ thread ถูกสร้างก่อน gunicorn fork worker
+class WebhookDispatcher:
+    def __init__(self, max_workers, queue_size, queue_timeout):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        # จำกัดจำนวนงานทั้งหมดในระบบ (กำลังทำ + รอคิว) เพื่อทำ backpressure
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._pending = 0
+        self._in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="webhook"
+                    )
+        return self._executor
+
+    def submit(self, func, *args):
+        """ส่งงานเข้าคิว คืนค่า False ถ้าคิวเต็มเกินเวลาที่กำหนด"""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            app_logger.warning(f"Webhook queue is full ({self.max_workers} workers, {self.queue_size} queued), rejecting request.")
+            return False
+        with self._lock:
+            self.submitted += 1
+            self._pending += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._pending)
+        try:
+            # ส่ง context (เช่น trace ID) ของ request ไปยัง worker thread ด้วย
+            self._get_executor().submit(contextvars.copy_context().run, self._run, func, args, time.time())
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            raise
+        return True
+
+    def _run(self, func, args, enqueued_at):
+        with self._lock:
+            self._pending -= 1
+            self._in_flight += 1
+        app_logger.debug(f"Webhook job waited {time.time() - enqueued_at:.3f} seconds in queue")
+        try:
+            func(*args)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            app_logger.exception(f"FATAL ERROR: Unhandled exception in background webhook processing: {e}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "async_mode": WEBHOOK_ASYNC_MODE,
+                "max_workers": self.max_workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self._pending,
+                "in_flight": self._in_flight,
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+webhook_dispatcher = WebhookDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_QUEUE_TIMEOUT)
+
 # --- Webhook Endpoint สำหรับ LINE OA ---
 @app.route("/callback", methods=['POST'])
 def callback():
+    request_trace_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:12]
+    _request_trace_id.set(request_trace_id)
+    _trace_id.set(request_trace_id)
+    _reply_deadline.set(None) # handle_message ตั้งใหม่ต่อ event (thread ของ Flask ถูกใช้ซ้ำ)
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     app_logger.info("Request body: " + body)
 
+    # ตรวจ signature แยกเป็นขั้นตอนของตัวเองทั้งสองโหมด (handler.handle จะตรวจซ้ำ ซึ่งใช้เวลาน้อยมาก)
+    with metrics.time_stage("signature"):
+        valid_signature = handler.parser.signature_validator.validate(body, signature)
+    if not valid_signature:
+        app_logger.error("Invalid signature. Check your channel secret.")
+        metrics.inc("linebot_webhook_requests_total", {"status": "400"})
+        abort(400)
+
+    if WEBHOOK_ASYNC_MODE:
+        # ตอบกลับทันที แล้วให้ worker pool ประมวลผล event ต่อ
+        if not webhook_dispatcher.submit(handler.handle, body, signature):
+            metrics.inc("linebot_webhook_requests_total", {"status": "503"})
+            abort(503) # คิวเต็ม ให้ LINE ส่ง webhook มาใหม่ภายหลัง
+        metrics.inc("linebot_webhook_requests_total", {"status": "200"})
+        return 'OK'
+
     try:
-        handler.handle(body, signature)
+        with metrics.time_stage("webhook"):
+            handler.handle(body, signature)
     except InvalidSignatureError:
         app_logger.error("Invalid signature. Check your channel secret.")
+        metrics.inc("linebot_webhook_requests_total", {"status": "400"})
         abort(400)
     except Exception as e:
         app_logger.exception(f"FATAL ERROR: Unhandled exception in handler.handle during LINE webhook processing: {e}")
+        metrics.inc("linebot_webhook_requests_total", {"status": "500"})
         abort(500)
+    metrics.inc("linebot_webhook_requests_total", {"status": "200"})
     return 'OK'
 
+# --- สถานะของคิว Webhook (ใช้ดู queue depth / backpressure) ---
+@app.route("/callback/stats", methods=['GET'])
+def callback_stats():
+    return jsonify(webhook_dispatcher.stats())
+
+# --- สถานะของ Cache ข้อมูลสินค้า ---
+@app.route("/admin/catalog_stats", methods=['GET'])
+def catalog_stats():
+    return jsonify(product_catalog.stats())
+
+# --- สถิติของ resolver ระบุเจตนาในเครื่อง ---
+@app.route("/admin/intent_stats", methods=['GET'])
+def intent_stats():
+    return jsonify(intent_resolver.stats())
+
+# --- เวลาตอบกลับของแต่ละ pipeline (p50/p95) ---
+@app.route("/admin/pipeline_stats", methods=['GET'])
+def pipeline_stats():
+    return jsonify({
+        "active_pipeline": ANSWER_PIPELINE,
+        "latency_seconds": pipeline_latency.stats(),
+        "prompt_tokens": prompt_tokens.stats(),
+        "context_token_budget": CONTEXT_TOKEN_BUDGET,
+    })
+
+# --- สถิติของ Cache ผลลัพธ์จาก OpenAI ---
+@app.route("/admin/response_cache_stats", methods=['GET'])
+def response_cache_stats():
+    return jsonify({
+        "enabled": RESPONSE_CACHE_ENABLED,
+        "answer_cache_active": answer_cache_active(),
+        "intent": intent_cache.stats(),
+        "answer": answer_cache.stats(),
+    })
+
+# --- สถานะของการเรียกบริการภายนอก (circuit breaker, retry, timeout ที่เลี่ยงได้) ---
+@app.route("/admin/outbound_stats", methods=['GET'])
+def outbound_stats():
+    return jsonify({
+        "reply_token_ttl": REPLY_TOKEN_TTL,
+        "reply_reserve_seconds": REPLY_RESERVE_SECONDS,
+        "intent_hedge_delay": INTENT_HEDGE_DELAY,
+        "services": {service.name: service.stats() for service in OUTBOUND_SERVICES},
+    })
+
+# --- Metrics แบบ Prometheus ---
+def scrape_gauges():
+    """ค่าที่คำนวณตอน scrape: (name, labels dict, value)"""
+    webhook = webhook_dispatcher.stats()
+    catalog = product_catalog.stats()
+    extra = [
+        ("linebot_webhook_queue_depth", {}, webhook["queue_depth"]),
+        ("linebot_webhook_in_flight", {}, webhook["in_flight"]),
+        ("linebot_catalog_products", {}, catalog["products"]),
+        ("linebot_catalog_version", {}, catalog["version"]),
+        ("linebot_idempotency_keys", {}, len(local_event_store)),
+        ("linebot_rate_limiter_users", {}, len(user_rate_limiter)),
+    ]
+    circuit_states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    for service in OUTBOUND_SERVICES:
+        extra.append(("linebot_circuit_state", {"service": service.name}, circuit_states[service.breaker.state]))
+        extra.append(("linebot_timeouts_avoided_total", {"service": service.name}, service.timeouts_avoided))
+    return extra
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    if metrics_store is not None:
+        body = metrics_store.render(scrape_gauges())
+    else:
+        body = metrics.render(scrape_gauges())
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 # --- Event Handler สำหรับ Text Message ---
+RATE_LIMITED_REPLY = "คุณส่งข้อความเร็วเกินไป กรุณารอสักครู่แล้วลองใหม่อีกครั้งนะคะ"
+
+def reply_text(reply_token, text):
+    with metrics.time_stage("reply"):
+        try:
+            line_service.call(
+                lambda timeout: line_bot_api.reply_message(reply_token, TextSendMessage(text=text), timeout=timeout)
+            )
+        except OutboundCallError as e:
+            # reply token หมดอายุแล้ว หรือ LINE ล่มอยู่ ไม่มีประโยชน์ที่จะรอเรียกต่อ
+            app_logger.error(f"Reply was not sent: {e}")
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    event_id = getattr(event, 'webhook_event_id', None)
+    if event_id:
+        _trace_id.set(f"{_request_trace_id.get()}/{event_id}") # webhook เดียวอาจมีหลาย event
+
+    # --- ตัด event ซ้ำ และผู้ใช้ที่ส่งข้อความถี่เกินไป ก่อนเข้าสู่ขั้นตอนที่ต้องเรียก OpenAI/Firestore ---
+    # ลำดับ: ตัดซ้ำใน process -> rate limit -> ตัดซ้ำกับ instance อื่น (Firestore) ข้อความที่ถูกจำกัดจึงไม่ต้องเขียน Firestore
+    is_redelivery = getattr(getattr(event, 'delivery_context', None), 'is_redelivery', None)
+    if not claim_event(event):
+        app_logger.info(f"Skipping duplicate webhook event {event_id} (redelivery={is_redelivery})")
+        metrics.inc("linebot_events_deduplicated_total")
+        return
+    user_id = getattr(event.source, 'user_id', None)
+    if RATE_LIMIT_ENABLED and user_id and not user_rate_limiter.allow(user_id):
+        app_logger.warning(f"Rate limit exceeded for user {user_id}")
+        metrics.inc("linebot_rate_limited_total")
+        if user_rate_limiter.should_notify(user_id):
+            reply_text(event.reply_token, RATE_LIMITED_REPLY)
+        return
+    if not claim_event_shared(event):
+        app_logger.info(f"Skipping webhook event {event_id} already processed by another instance (redelivery={is_redelivery})")
+        metrics.inc("linebot_events_deduplicated_total")
+        return
+    start_reply_deadline(getattr(event, 'timestamp', None))
+
     user_message = event.message.text
     reply_message = "ขออภัยค่ะ ไม่เข้าใจคำถามของคุณ ลองถามใหม่นะคะ"
+    action, query_params, retrieved_data = "unknown", None, None
 
     app_logger.debug(f"\n--- New Message from LINE ---")
     app_logger.debug(f"User message received: '{user_message}'")
     start_total_time = time.time()
 
     try:
-        # --- ขั้นตอนที่ 1: ให้ OpenAI GPT ระบุ "เจตนา" และข้อมูลที่ต้องการจากคำถามผู้ใช้ ---
-        start_openai_intent_time = time.time()
-        
-        # Prompt สำหรับ OpenAI GPT
-        # เราใช้ ChatCompletion API ของ OpenAI
-        messages_for_intent = [
-            {"role": "system", "content": f"""
-            คุณคือผู้ช่วย AI ที่เชี่ยวชาญในการทำความเข้าใจคำถามและระบุข้อมูลที่จำเป็นจากฐานข้อมูลสินค้า.
-            ฐานข้อมูลของเรามี Collection 'products' ที่มีโครงสร้างดังนี้:
-            {FIRESTORE_SCHEMA_DESCRIPTION}
-
-            จากคำถามของผู้ใช้ โปรดระบุ "action" ที่เหมาะสมที่สุดเพื่อดึงข้อมูลจากฐานข้อมูล.
-            และระบุ "query_params" ที่จำเป็นสำหรับ action นั้นๆ.
-            
-            รูปแบบการตอบกลับต้องเป็น JSON เท่านั้น. ห้ามมีข้อความอื่นใดๆ เพิ่มเติม.
-
-            Possible actions:
-            - "fetch_all_products": เมื่อผู้ใช้ต้องการข้อมูลสินค้าทั้งหมด (ไม่มี query_params)
-            - "fetch_by_name": เมื่อผู้ใช้ถามถึงข้อมูลเฉพาะของสินค้าด้วยชื่อ (query_params: {{"name": "ชื่อสินค้า"}})
-            - "fetch_by_category": เมื่อผู้ใช้ถามถึงสินค้าในหมวดหมู่ใดหมวดหมู่หนึ่ง (query_params: {{"category": "ชื่อหมวดหมู่"}})
-            - "unknown": เมื่อไม่สามารถระบุ action ได้ (ไม่มี query_params)
-
-            ตัวอย่างการตอบกลับ:
-            - สำหรับ "มีสินค้าอะไรบ้าง": {{"action": "fetch_all_products"}}
-            - สำหรับ "ราคา iPhone 15 เท่าไหร่": {{"action": "fetch_by_name", "query_params": {{"name": "iPhone 15"}}}}
-            - สำหรับ "สินค้าหมวด Laptops มีอะไรบ้าง": {{"action": "fetch_by_category", "query_params": {{"category": "Laptops"}}}}
-            - สำหรับ "สวัสดี": {{"action": "unknown"}}
-            """},
-            {"role": "user", "content": user_message}
-        ]
-
-        intent_response_openai = client.chat.completions.create(
-            model="gpt-3.5-turbo", # สามารถลองใช้ "gpt-4o" หรือรุ่นอื่นที่คุณมีสิทธิ์เข้าถึง
-            messages=messages_for_intent,
-            response_format={"type": "json_object"} # สำคัญมากเพื่อให้ GPT ตอบกลับมาเป็น JSON
-        )
-        intent_json_str = intent_response_openai.choices[0].message.content.strip()
-        app_logger.debug(f"Time for OpenAI Intent generation: {time.time() - start_openai_intent_time:.2f} seconds")
-        app_logger.debug(f"OpenAI Intent JSON: {intent_json_str}")
+        # --- ขั้นตอนที่ 1: ระบุ "เจตนา" ด้วย resolver ในเครื่องก่อน ถ้าไม่มั่นใจจึงถาม OpenAI GPT ---
+        local_intent = None
+        if FAST_INTENT_ENABLED and PRODUCT_CACHE_ENABLED: # resolver ใช้ชื่อสินค้าจาก product_catalog
+            with metrics.time_stage("intent_local"):
+                local_intent = intent_resolver.resolve(user_message)
 
-        action = "unknown"
-        query_params = None
-        try:
-            intent_data = json.loads(intent_json_str)
-            action = intent_data.get('action')
-            query_params = intent_data.get('query_params')
-            app_logger.debug(f"Parsed action: '{action}', params: '{query_params}'")
-        except json.JSONDecodeError:
-            app_logger.error(f"Failed to parse JSON from OpenAI: {intent_json_str}")
-            # action ยังคงเป็น "unknown" ตามค่าเริ่มต้น
-
-        retrieved_data = None
-        if action != "unknown":
-            retrieved_data = get_product_data(action, query_params)
-            if isinstance(retrieved_data, str): # ถ้ามี error จาก Firestore (ฟังก์ชัน get_product_data คืนค่าเป็น string)
-                reply_message = retrieved_data
-                app_logger.error(f"Firestore data retrieval failed: {reply_message}")
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_message))
-                return
-            app_logger.debug(f"Retrieved data from Firestore: {json.dumps(retrieved_data, ensure_ascii=False)}")
+        if ANSWER_PIPELINE == "tools":
+            # ให้ GPT เรียก get_product_data เองผ่าน tool calling แล้วตอบใน conversation เดียวกัน
+            action, query_params = local_intent if local_intent is not None else ("tools", None)
+            compute_answer = lambda: generate_answer_with_tools(user_message, local_intent)
+            if answer_cache_active():
+                reply_message = answer_cache.get_or_compute(
+                    answer_cache_key(user_message, action, query_params),
+                    product_catalog.dependency_version(action, query_params),
+                    compute_answer
+                )
+            else:
+                reply_message = compute_answer()
         else:
-            app_logger.debug(f"Action is 'unknown', skipping data retrieval.")
+            if local_intent is not None:
+                action, query_params = local_intent
+            elif RESPONSE_CACHE_ENABLED:
+                action, query_params = intent_cache.get_or_compute(
+                    normalize_text(user_message), None, lambda: generate_intent_with_openai(user_message)
+                )
+            else:
+                action, query_params = generate_intent_with_openai(user_message)
 
-        # --- ขั้นตอนที่ 2: ให้ OpenAI GPT สังเคราะห์คำตอบจากข้อมูลที่ดึงมา ---
-        start_openai_answer_time = time.time()
-        
-        messages_for_answer = [
-            {"role": "system", "content": f"""
-            คุณคือผู้ช่วย AI ที่เป็นมิตรและเป็นประโยชน์.
-            ผู้ใช้ถามคำถาม: "{user_message}"
-            นี่คือข้อมูลที่เรามีจากฐานข้อมูลสินค้า (Firebase Firestore):
-            {json.dumps(retrieved_data, indent=2, ensure_ascii=False) if retrieved_data else "ไม่พบข้อมูลที่เกี่ยวข้อง"}
-
-            โปรดตอบคำถามของผู้ใช้ด้วยภาษาที่เป็นธรรมชาติและเป็นประโยชน์อย่างยิ่ง โดยอ้างอิงจากข้อมูลที่ให้มาเท่านั้น.
-            หากข้อมูลที่ให้มาไม่เพียงพอที่จะตอบคำถามได้ตรงๆ ให้ตอบกลับอย่างสุภาพและบอกว่าเรามีข้อมูลอะไรบ้างที่เกี่ยวข้องแทน.
-            ห้ามสร้างข้อมูลเอง.
-            
-            ตัวอย่างการตอบ:
-            - ถ้าถามราคา iPhone 15 และมีข้อมูล: "iPhone 15 มีราคา 35,000 บาทค่ะ"
-            - ถ้าถามสินค้าหมวด Laptops และมีข้อมูล: "สินค้าในหมวด Laptops ได้แก่ MacBook Air M3 (ราคา 45,000 บาท) และ Dell XPS 15 (ราคา 55,000 บาท) ค่ะ"
-            - ถ้าถามเรื่องสต็อก: "สินค้า iPhone 15 มีสต็อก 100 ชิ้นค่ะ"
-            - ถ้าถามสิ่งที่ข้อมูลไม่มี: "ขออภัยค่ะ ไม่พบข้อมูลเกี่ยวกับเรื่องนั้นในฐานข้อมูลของเราในขณะนี้"
-            """},
-            {"role": "user", "content": user_message}
-        ]
-
-        final_answer_openai = client.chat.completions.create(
-            model="gpt-3.5-turbo", # สามารถลองใช้ "gpt-4o" หรือรุ่นอื่นที่คุณมีสิทธิ์เข้าถึง
-            messages=messages_for_answer
-        )
-        reply_message = final_answer_openai.choices[0].message.content.strip()
-        app_logger.debug(f"Time for OpenAI Answer generation: {time.time() - start_openai_answer_time:.2f} seconds")
-        app_logger.debug(f"Final reply message to LINE: '{reply_message}'")
+            # อ่าน version ก่อนดึงข้อมูล ถ้ามีการแก้ไขระหว่างนั้น คำตอบจะถูกเก็บด้วย version เก่าและไม่ถูกใช้ซ้ำ
+            answer_version = product_catalog.dependency_version(action, query_params)
+            if action != "unknown":
+                retrieved_data = get_product_data(action, query_params)
+                if isinstance(retrieved_data, str): # ถ้ามี error จาก Firestore (ฟังก์ชัน get_product_data คืนค่าเป็น string)
+                    reply_message = retrieved_data
+                    app_logger.error(f"Firestore data retrieval failed: {reply_message}")
+                    metrics.inc("linebot_errors_total", {"stage": "retrieval", "type": "FirestoreError"})
+                    reply_text(event.reply_token, reply_message)
+                    return
+                app_logger.debug(f"Retrieved data from Firestore: {json.dumps(retrieved_data, ensure_ascii=False)}")
+            else:
+                app_logger.debug(f"Action is 'unknown', skipping data retrieval.")
+
+            # --- ขั้นตอนที่ 2: ให้ OpenAI GPT สังเคราะห์คำตอบจากข้อมูลที่ดึงมา ---
+            if answer_cache_active():
+                reply_message = answer_cache.get_or_compute(
+                    answer_cache_key(user_message, action, query_params),
+                    answer_version,
+                    lambda: generate_answer_with_openai(user_message, retrieved_data, action)
+                )
+            else:
+                reply_message = generate_answer_with_openai(user_message, retrieved_data, action)
 
         if not reply_message: # ถ้าข้อความเป็นค่าว่าง
             reply_message = "ขออภัยค่ะ ไม่สามารถสร้างคำตอบได้ในขณะนี้ โปรดลองอีกครั้ง."
             app_logger.warning("Reply message was empty, setting fallback.")
 
-    except openai.APIError as e: # Catch errors specific to OpenAI API
-        app_logger.error(f"OpenAI API Error: {e}")
-        reply_message = "เกิดข้อผิดพลาดในการเชื่อมต่อกับ AI กรุณาลองใหม่อีกครั้งค่ะ"
+    except ProductDataError as e:
+        app_logger.error(f"Firestore data retrieval failed: {e}")
+        metrics.inc("linebot_errors_total", {"stage": "retrieval", "type": "FirestoreError"})
+        reply_message = str(e)
+    except (OutboundCallError, openai.APIError) as e: # วงจรถูกตัด, เวลาไม่พอ หรือ error จาก OpenAI API
+        app_logger.error(f"OpenAI call failed ({type(e).__name__}): {e}")
+        # ตอบจาก template ด้วยข้อมูลสินค้าที่ดึงมาล่าสุด แทนการตอบว่าเกิดข้อผิดพลาด
+        if retrieved_data is None and action in PRODUCT_DATA_ACTIONS:
+            retrieved_data = get_product_data(action, query_params)
+        fallback_data = retrieved_data if isinstance(retrieved_data, list) and retrieved_data else product_catalog.snapshot()
+        reply_message = render_fallback_answer(user_message, fallback_data)
+        if reply_message:
+            metrics.inc("linebot_fallback_replies_total")
+        else:
+            reply_message = "เกิดข้อผิดพลาดในการเชื่อมต่อกับ AI กรุณาลองใหม่อีกครั้งค่ะ"
     except Exception as e:
         app_logger.exception(f"FATAL ERROR: Unhandled exception in handle_message: {e}")
         reply_message = "เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้งค่ะ"
 
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=reply_message)
-    )
-    app_logger.debug(f"--- End of Message Handling (Total Time: {time.time() - start_total_time:.2f} seconds) ---")
+    reply_text(event.reply_token, reply_message)
+    total_time = time.time() - start_total_time
+    pipeline_latency.record(ANSWER_PIPELINE, total_time)
+    if startup_stats["first_reply_seconds"] is None:
+        startup_stats["first_reply_seconds"] = round(time.time() - _worker_started_at, 3)
+        app_logger.info(f"Time to first reply since worker start: {startup_stats['first_reply_seconds']:.2f} seconds")
+    metrics.observe("linebot_stage_duration_seconds", total_time, {"stage": "total"})
+    app_logger.debug(f"--- End of Message Handling (Total Time: {total_time:.2f} seconds) ---")
 
 
 # --- Route สำหรับหน้า Admin Dashboard (ใช้ Firestore) ---
+# แบ่งหน้าด้วย cursor (document ID ของรายการสุดท้าย) ค้นหาด้วย prefix ของชื่อ และเรียงตาม field ที่เลือก
+ADMIN_SORT_FIELDS = ['name', 'price', 'stock', 'category']
+
 @app.route("/admin")
 def admin_dashboard():
-    products_ref = db.collection('products')
+    search = request.args.get('q', '').strip()
+    sort_by = request.args.get('sort', 'name')
+    if sort_by not in ADMIN_SORT_FIELDS:
+        sort_by = 'name'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    cursor = request.args.get('cursor') or None
+    try:
+        page_size = max(1, min(int(request.args.get('page_size', ADMIN_PAGE_SIZE)), ADMIN_MAX_PAGE_SIZE))
+    except ValueError:
+        page_size = ADMIN_PAGE_SIZE
+
+    spec = {'filters': [], 'order_by': sort_by, 'direction': order, 'limit': page_size, 'start_after': cursor}
+    if search:
+        # Firestore กำหนดให้ field ที่ใช้ range filter ต้องเป็น field แรกที่ใช้เรียง
+        spec['filters'] = [('name_lower', '>=', search.lower()), ('name_lower', '<=', search.lower() + '\uf8ff')]
+        spec['order_by'] = 'name_lower'
+
     products = []
+    next_cursor = None
     try:
-        for doc in products_ref.stream():
-            product_data = doc.to_dict()
-            product_data['id'] = doc.id 
-            products.append(product_data)
+        if PRODUCT_CACHE_ENABLED:
+            products = _run_query_in_memory(product_catalog.all(with_id=True), spec)
+        else:
+            products = _run_query_on_firestore(spec)
+        if len(products) == page_size:
+            next_cursor = products[-1]['id']
         app_logger.debug(f"Loaded {len(products)} products for admin dashboard.")
     except Exception as e:
         app_logger.error(f"Failed to load products for admin dashboard: {e}")
         flash(f"เกิดข้อผิดพลาดในการโหลดสินค้า: {e}", "danger")
-    return render_template("admin.html", products=products)
+    return render_template(
+        "admin.html",
+        products=products,
+        search=search,
+        sort_by=sort_by,
+        order=order,
+        page_size=page_size,
+        cursor=cursor,
+        next_cursor=next_cursor,
+    )
+
+# --- แปลงข้อมูลจากไฟล์ import (CSV/JSON) เป็นข้อมูลสินค้า ---
+def _product_from_row(row):
+    product_data = {
+        'name': str(row['name']).strip(),
+        'price': float(str(row['price']).replace(',', '')),
+        'stock': int(str(row['stock']).replace(',', '')),
+        'category': str(row['category']).strip(),
+    }
+    if not product_data['name']:
+        raise ValueError("name is empty")
+    product_data['name_lower'] = product_data['name'].lower() # ใช้สำหรับ search_by_name
+    return product_data
+
+def _iter_import_rows(uploaded_file, file_format):
+    if file_format == 'json':
+        rows = json.load(uploaded_file.stream)
+        if isinstance(rows, dict): # รองรับ {"products": [...]}
+            rows = rows.get('products', [])
+        yield from rows
+    else:
+        # อ่าน CSV ทีละบรรทัดจาก stream ไม่ต้องโหลดทั้งไฟล์เข้าหน่วยความจำ
+        yield from csv.DictReader(io.TextIOWrapper(uploaded_file.stream, encoding='utf-8-sig'))
+
+# --- Route สำหรับ Import สินค้าจำนวนมาก (Firestore batched write) ---
+@app.route("/admin/import", methods=['POST'])
+def import_products():
+    uploaded_file = request.files.get('file')
+    if not uploaded_file or not uploaded_file.filename:
+        flash("กรุณาเลือกไฟล์ CSV หรือ JSON", "danger")
+        return redirect(url_for('admin_dashboard'))
+    file_format = 'json' if uploaded_file.filename.lower().endswith('.json') else 'csv'
+
+    start_time = time.time()
+    products_ref = db.collection('products')
+    imported = 0
+    errors = []
+    batch = db.batch()
+    pending = [] # (product_id, product_data) ที่อยู่ใน batch ปัจจุบัน
+
+    def commit_batch():
+        nonlocal batch, imported
+        if not pending:
+            return
+        batch.commit()
+        for product_id, product_data in pending:
+            product_catalog.upsert(product_id, product_data, merge=True)
+        imported += len(pending)
+        pending.clear()
+        batch = db.batch()
+
+    try:
+        for line_number, row in enumerate(_iter_import_rows(uploaded_file, file_format), start=1):
+            try:
+                product_data = _product_from_row(row)
+                product_id = str(row.get('id') or '').strip()
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                errors.append(f"แถวที่ {line_number}: {e}")
+                continue
+            doc_ref = products_ref.document(product_id) if product_id else products_ref.document()
+            batch.set(doc_ref, product_data, merge=True)
+            pending.append((doc_ref.id, product_data))
+            if len(pending) >= FIRESTORE_BATCH_LIMIT:
+                commit_batch()
+        commit_batch()
+    except Exception as e:
+        app_logger.error(f"Failed to import products: {e}")
+        flash(f"เกิดข้อผิดพลาดในการ import สินค้า (บันทึกไปแล้ว {imported} รายการ): {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+
+    app_logger.debug(f"Imported {imported} products ({len(errors)} rows skipped) in {time.time() - start_time:.2f} seconds")
+    flash(f"Import สินค้าเรียบร้อยแล้ว {imported} รายการ", "success")
+    if errors:
+        flash(f"ข้ามแถวที่ผิดรูปแบบ {len(errors)} แถว: " + "; ".join(errors[:5]), "danger")
+    return redirect(url_for('admin_dashboard'))
+
+# --- Route สำหรับเติม name_lower ให้สินค้าเก่า (ใช้เมื่อปิด PRODUCT_CACHE_ENABLED จึงไม่มี reload ที่เติมให้) ---
+@app.route("/admin/backfill_name_lower", methods=['POST'])
+def backfill_name_lower_endpoint():
+    start_time = time.time()
+    try:
+        updated = backfill_name_lower()
+    except Exception as e:
+        app_logger.error(f"Failed to backfill name_lower: {e}")
+        flash(f"เกิดข้อผิดพลาดในการเติมข้อมูลสำหรับค้นหา: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    app_logger.debug(f"Backfilled name_lower for {updated} products in {time.time() - start_time:.2f} seconds")
+    flash(f"เติมข้อมูลสำหรับค้นหาชื่อสินค้าเรียบร้อยแล้ว {updated} รายการ", "success")
+    return redirect(url_for('admin_dashboard'))
+
+# --- Route สำหรับ Export สินค้าทั้งหมด (ส่งข้อมูลแบบ stream) ---
+EXPORT_FIELDS = ['id', 'name', 'price', 'stock', 'category']
+
+@app.route("/admin/export")
+def export_products():
+    file_format = 'json' if request.args.get('format') == 'json' else 'csv'
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for doc in db.collection('products').stream():
+            writer.writerow({**doc.to_dict(), 'id': doc.id})
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+
+    def generate_json():
+        yield "[\n"
+        separator = ""
+        for doc in db.collection('products').stream():
+            product_data = {field: value for field, value in doc.to_dict().items() if field in EXPORT_FIELDS}
+            product_data['id'] = doc.id
+            yield separator + json.dumps(product_data, ensure_ascii=False)
+            separator = ",\n"
+        yield "\n]\n"
+
+    if file_format == 'json':
+        body, mimetype = generate_json(), 'application/json'
+    else:
+        body, mimetype = generate_csv(), 'text/csv'
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=products.{file_format}'},
+    )
 
 # --- Route สำหรับเพิ่มสินค้า (ใช้ Firestore) ---
 @app.route("/admin/add_product", methods=['GET', 'POST'])
@@ -280,9 +2619,11 @@ def add_product():
             'stock': int(request.form['stock']),
             'category': request.form['category']
         }
+        product_data['name_lower'] = product_data['name'].lower() # ใช้สำหรับ search_by_name
         try:
             doc_ref = db.collection('products').document()
             doc_ref.set(product_data)
+            product_catalog.upsert(doc_ref.id, product_data)
             flash(f"สินค้าถูกเพิ่มเรียบร้อยแล้ว! (ID: {doc_ref.id})", "success")
             app_logger.debug(f"Added product: {product_data['name']} with ID: {doc_ref.id}")
         except Exception as e:
@@ -312,8 +2653,10 @@ def edit_product(product_id):
             'stock': int(request.form['stock']),
             'category': request.form['category']
         }
+        updated_data['name_lower'] = updated_data['name'].lower() # ใช้สำหรับ search_by_name
         try:
             doc_ref.set(updated_data, merge=True) 
+            product_catalog.upsert(product_id, updated_data, merge=True)
             flash("สินค้าถูกแก้ไขเรียบร้อยแล้ว!", "success")
             app_logger.debug(f"Updated product ID: {product_id} with data: {updated_data}")
         except Exception as e:
@@ -328,6 +2671,7 @@ def edit_product(product_id):
 def delete_product(product_id):
     try:
         db.collection('products').document(product_id).delete()
+        product_catalog.remove(product_id)
         flash("สินค้าถูกลบเรียบร้อยแล้ว!", "success")
         app_logger.debug(f"Deleted product ID: {product_id}")
     except Exception as e:
@@ -335,7 +2679,63 @@ def delete_product(product_id):
         app_logger.error(f"Failed to delete product ID: {product_id} - {e}")
     return redirect(url_for('admin_dashboard'))
 
+# --- Startup: preload, warm-up และ health check ---
+def preload_modules():
+    """import module ที่หนักใน gunicorn master (preload) เพื่อให้ทุก worker ใช้ร่วมกันหลัง fork"""
+    start_time = time.time()
+    for module_name in ("openai", "firebase_admin.firestore"):
+        importlib.import_module(module_name)
+    app_logger.info(f"Preloaded heavy modules in {time.time() - start_time:.2f} seconds")
+
+def mark_worker_started():
+    """เรียกหลัง fork เพื่อให้ time-to-first-reply นับจากเวลาที่ worker เริ่ม และเริ่มเขียน metrics ของ worker นี้"""
+    global _worker_started_at
+    _worker_started_at = time.time()
+    if metrics_store is not None:
+        metrics_store.start(scrape_gauges)
+
+def warm_up():
+    """สร้าง client ทั้งหมด เปิด keep-alive connection และโหลด product catalog ล่วงหน้า"""
+    start_time = time.time()
+    results = {}
+    steps = [
+        ("firestore", lambda: product_catalog.ensure_fresh() if PRODUCT_CACHE_ENABLED
+            else list(db.collection('products').limit(1).stream())),
+        ("openai", lambda: client.models.retrieve("gpt-3.5-turbo")),
+        ("line", lambda: line_bot_api.get_bot_info()),
+    ]
+    for name, step in steps:
+        step_start = time.time()
+        try:
+            step()
+            results[name] = {"ok": True, "seconds": round(time.time() - step_start, 3)}
+        except Exception as e:
+            app_logger.error(f"Warm-up step '{name}' failed: {e}")
+            results[name] = {"ok": False, "seconds": round(time.time() - step_start, 3), "error": str(e)}
+    startup_stats["warm_up_seconds"] = round(time.time() - start_time, 3)
+    app_logger.info(f"Warm-up finished in {startup_stats['warm_up_seconds']:.2f} seconds: {results}")
+    return results
+
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    return jsonify({
+        "status": "ok",
+        "clients_initialized": {"firestore": db.initialized, "openai": client.initialized, "line": line_bot_api.initialized},
+        "startup": startup_stats,
+    })
+
+@app.route("/warmup", methods=['GET', 'POST'])
+def warmup_endpoint():
+    results = warm_up()
+    status = 200 if all(result["ok"] for result in results.values()) else 503
+    return jsonify({"steps": results, "startup": startup_stats}), status
+
+startup_stats["import_seconds"] = round(time.time() - _module_load_started, 3)
+app_logger.info(f"app module loaded in {startup_stats['import_seconds']:.2f} seconds")
+
 # --- รัน Flask App ---
 if __name__ == "__main__":
+    if WARM_UP_ON_START:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
     port = int(os.environ.get('PORT', 10000)) # Render จะกำหนด PORT ให้
     app.run(host='0.0.0.0', port=port) # รันบน 0.0.0.0 เพื่อให้เข้าถึงได้จากภายนอก
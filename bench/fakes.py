@@ -0,0 +1,345 @@
+# --- ตัวแทนบริการภายนอกสำหรับ benchmark (ไม่ต้องใช้ credential จริง) ---
+# - FakeFirestore: Firestore ในหน่วยความจำ (รองรับ where/order_by/limit/start_after, batch, on_snapshot)
+# - MockServiceServer: HTTP server จำลอง OpenAI (/v1/chat/completions) และ LINE (/v2/bot/message/reply)
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Firestore ในหน่วยความจำ ---
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+}
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data, read_latency):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+        time.sleep(read_latency)
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self):
+        return FakeDocumentSnapshot(self.id, self._collection.docs.get(self.id), self._collection.db.read_latency)
+
+    def set(self, data, merge=False):
+        self._collection.write(self.id, data, merge)
+
+    def create(self, data):
+        from google.api_core.exceptions import AlreadyExists
+        with self._collection.db.lock:
+            if self.id in self._collection.docs:
+                raise AlreadyExists(f"Document already exists: {self.id}")
+            self._collection.write(self.id, data)
+
+    def delete(self):
+        self._collection.remove(self.id)
+
+class _ChangeType:
+    def __init__(self, name):
+        self.name = name
+
+class _DocumentChange:
+    def __init__(self, change_type, document):
+        self.type = _ChangeType(change_type)
+        self.document = document
+
+class FakeWatch:
+    is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), order=None, limit=None, start_after=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        values = dict(filters=self._filters, order=self._order, limit=self._limit, start_after=self._start_after)
+        values.update(changes)
+        return FakeQuery(self._collection, **values)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(order=(field, direction))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot.id)
+
+    def stream(self):
+        db = self._collection.db
+        items = [
+            (doc_id, data) for doc_id, data in self._collection.docs.items()
+            if all(field in data and _OPERATORS[op](data[field], value) for field, op, value in self._filters)
+        ]
+        if self._order:
+            field, direction = self._order
+            items = [item for item in items if field in item[1]]
+            items.sort(key=lambda item: (item[1][field], item[0]), reverse=direction == 'DESCENDING')
+        if self._start_after is not None:
+            ids = [doc_id for doc_id, _ in items]
+            if self._start_after in ids:
+                items = items[ids.index(self._start_after) + 1:]
+        if self._limit is not None:
+            items = items[:self._limit]
+        time.sleep(db.query_latency)
+        for doc_id, data in items:
+            yield FakeDocumentSnapshot(doc_id, data, 0)
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(self)
+        self.db = db
+        self.name = name
+        self.docs = {}
+        self._listeners = []
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or uuid.uuid4().hex[:20])
+
+    def write(self, doc_id, data, merge=False):
+        with self.db.lock:
+            change = 'MODIFIED' if doc_id in self.docs else 'ADDED'
+            self.docs[doc_id] = {**self.docs.get(doc_id, {}), **data} if merge else dict(data)
+            self._notify([_DocumentChange(change, FakeDocumentSnapshot(doc_id, self.docs[doc_id], 0))])
+
+    def remove(self, doc_id):
+        with self.db.lock:
+            data = self.docs.pop(doc_id, None)
+            if data is not None:
+                self._notify([_DocumentChange('REMOVED', FakeDocumentSnapshot(doc_id, data, 0))])
+
+    def _notify(self, changes):
+        for callback in self._listeners:
+            callback(None, changes, None)
+
+    def on_snapshot(self, callback):
+        self._listeners.append(callback)
+        callback(None, [_DocumentChange('ADDED', FakeDocumentSnapshot(doc_id, data, 0)) for doc_id, data in self.docs.items()], None)
+        return FakeWatch()
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def set(self, doc_ref, data, merge=False):
+        if len(self._operations) >= 500:
+            raise ValueError("Firestore batches are limited to 500 operations")
+        self._operations.append((doc_ref, data, merge))
+
+    def commit(self):
+        time.sleep(self._db.query_latency)
+        for doc_ref, data, merge in self._operations:
+            doc_ref.set(data, merge=merge)
+
+class FakeFirestore:
+    def __init__(self, query_latency=0.0, read_latency=0.0):
+        self.query_latency = query_latency
+        self.read_latency = read_latency
+        self.lock = threading.RLock()
+        self._collections = {}
+
+    def collection(self, name):
+        with self.lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(self, name)
+            return self._collections[name]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+def seed_products(db, count, categories=("Smartphones", "Laptops", "Accessories", "Tablets")):
+    """ใส่สินค้าตัวอย่าง (รวม iPhone 15 / MacBook Air M3 ที่ใช้ในตัวอย่าง prompt)"""
+    products = db.collection('products')
+    rng = random.Random(42)
+    base = [
+        {'name': 'iPhone 15', 'price': 35000.0, 'stock': 100, 'category': 'Smartphones'},
+        {'name': 'MacBook Air M3', 'price': 45000.0, 'stock': 50, 'category': 'Laptops'},
+        {'name': 'Keyboard', 'price': 1200.0, 'stock': 200, 'category': 'Accessories'},
+    ]
+    for i in range(max(0, count - len(base))):
+        base.append({
+            'name': f"Product {i:05d}",
+            'price': float(rng.randint(100, 90000)),
+            'stock': rng.randint(0, 300),
+            'category': rng.choice(categories),
+        })
+    for product in base[:count]:
+        product['name_lower'] = product['name'].lower()
+        products.document().set(product)
+
+def _emulator_credential_base():
+    from firebase_admin import credentials
+    return credentials.Base
+
+class EmulatorCredential(_emulator_credential_base()):
+    """credential สำหรับ Firestore emulator (emulator ไม่ตรวจ token จึงใช้ AnonymousCredentials)"""
+    def __init__(self, project_id):
+        self._project_id = project_id
+
+    @property
+    def project_id(self):
+        return self._project_id
+
+    def get_credential(self):
+        from google.auth.credentials import AnonymousCredentials
+        return AnonymousCredentials()
+
+# --- HTTP server จำลอง OpenAI และ LINE ---
+class MockServiceServer:
+    """server เดียวที่ตอบทั้ง OpenAI chat completions และ LINE reply API พร้อม latency ที่ตั้งค่าได้"""
+
+    def __init__(self, openai_latency=0.3, openai_jitter=0.1, line_latency=0.05, host='127.0.0.1', port=0):
+        self.openai_latency = openai_latency
+        self.openai_jitter = openai_jitter
+        self.line_latency = line_latency
+        self.replies = {} # replyToken -> เวลาที่ได้รับ reply
+        self.reply_event = threading.Condition()
+        self.openai_calls = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _openai_delay(self):
+        return max(0.0, self.openai_latency + random.uniform(-self.openai_jitter, self.openai_jitter))
+
+    def wait_for_reply(self, reply_token, timeout):
+        deadline = time.time() + timeout
+        with self.reply_event:
+            while reply_token not in self.replies:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.reply_event.wait(remaining)
+            return self.replies[reply_token]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = self._read_json()
+                if self.path.endswith('/chat/completions'):
+                    with server._lock:
+                        server.openai_calls += 1
+                    time.sleep(server._openai_delay())
+                    if payload.get('stream'):
+                        self._stream_completion(payload)
+                    else:
+                        self._send_json(self._completion(payload))
+                elif self.path.endswith('/v2/bot/message/reply'):
+                    time.sleep(server.line_latency)
+                    with server.reply_event:
+                        server.replies[payload.get('replyToken')] = time.time()
+                        server.reply_event.notify_all()
+                    self._send_json({})
+                else:
+                    self._send_json({"message": "not found"}, status=404)
+
+            @staticmethod
+            def _intent_for(messages):
+                text = messages[-1].get('content') or ''
+                if 'iphone' in text.lower():
+                    return {"action": "fetch_by_name", "query_params": {"name": "iPhone 15"}}
+                if 'laptop' in text.lower():
+                    return {"action": "fetch_by_category", "query_params": {"category": "Laptops"}}
+                return {"action": "fetch_all_products"}
+
+            def _completion(self, payload):
+                if payload.get('response_format', {}).get('type') == 'json_object':
+                    content = json.dumps(self._intent_for(payload['messages']))
+                else:
+                    content = "ขอบคุณที่สอบถามค่ะ นี่คือข้อมูลสินค้าที่เกี่ยวข้อง"
+                prompt_tokens = sum(len(m.get('content') or '') for m in payload.get('messages', [])) // 3
+                return {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get('model', 'mock'),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20,
+                              "total_tokens": prompt_tokens + 20},
+                }
+
+            def _stream_completion(self, payload):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+                def send(chunk):
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+
+                base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": "mock"}
+                has_tool_result = any(m.get('role') == 'tool' for m in payload.get('messages', []))
+                if payload.get('tools') and payload.get('tool_choice') == 'auto' and not has_tool_result:
+                    arguments = json.dumps(self._intent_for(payload['messages']))
+                    send({**base, "choices": [{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "tool_calls": [
+                        {"index": 0, "id": "call_mock", "type": "function",
+                         "function": {"name": "get_product_data", "arguments": arguments}}]}}]})
+                else:
+                    for token in ["ขอบคุณ", "ที่สอบถาม", "ค่ะ"]:
+                        send({**base, "choices": [{"index": 0, "finish_reason": None, "delta": {"content": token}}]})
+                send({**base, "choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
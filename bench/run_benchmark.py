@@ -0,0 +1,270 @@
+"""Benchmark แบบ offline สำหรับ app.py
+
+รัน Flask app (ผ่าน WSGI test client) กับบริการจำลองทั้งหมด:
+- webhook ที่เซ็น X-Line-Signature แล้ว ส่งตามอัตราที่กำหนด (open loop)
+- OpenAI และ LINE reply API จำลองด้วย HTTP server ในเครื่อง (กำหนด latency ได้)
+- Firestore ในหน่วยความจำ (หรือ Firestore emulator ด้วย --firestore emulator)
+
+ตัวอย่าง:
+    python bench/run_benchmark.py --rate 20 --duration 30 --env WEBHOOK_ASYNC_MODE=1
+    python bench/run_benchmark.py --json current.json --baseline baseline.json --max-regression 0.2
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import EmulatorCredential, FakeFirestore, MockServiceServer, seed_products
+
+CHANNEL_SECRET = "benchmark-channel-secret"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the LINE chatbot webhook.")
+    parser.add_argument("--rate", type=float, default=10.0, help="webhook requests per second")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to send requests for")
+    parser.add_argument("--warmup", type=int, default=5, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=32, help="client threads sending webhooks")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="distinct LINE user IDs to spread requests over (per-user rate limiting applies)")
+    parser.add_argument("--payloads", default=os.path.join(BENCH_DIR, "payloads.jsonl"),
+                        help="JSONL file: webhook bodies ({\"events\": [...]}) or {\"text\": \"...\"} lines")
+    parser.add_argument("--products", type=int, default=500, help="products seeded into the in-memory Firestore")
+    parser.add_argument("--firestore", choices=["memory", "emulator"], default="memory",
+                        help="'emulator' uses the Firestore emulator at FIRESTORE_EMULATOR_HOST (no credentials needed)")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="seconds per in-memory Firestore query")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="mean seconds per mock OpenAI call")
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--line-latency", type=float, default=0.05, help="seconds per mock LINE reply call")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="seconds to wait for outstanding replies")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for app.py, e.g. ANSWER_PIPELINE=tools (repeatable)")
+    parser.add_argument("--log-level", default="WARNING", help="app_logger level during the run (DEBUG logs skew timings)")
+    parser.add_argument("--json", dest="json_out", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed relative slowdown of end-to-end p95 / throughput vs --baseline")
+    return parser.parse_args()
+
+def load_app(args, mock):
+    """ตั้งค่า environment และ Firestore จำลอง แล้วจึง import app (app ตรวจ env ตอน import)"""
+    os.environ.update({
+        "LINE_CHANNEL_ACCESS_TOKEN": "benchmark-token",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "OPENAI_API_KEY": "benchmark-key",
+        "OPENAI_BASE_URL": mock.base_url + "/v1",
+        "LINE_API_ENDPOINT": mock.base_url,
+    })
+    os.environ.setdefault("FIREBASE_SERVICE_ACCOUNT_JSON", "{}")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    fake_db = None
+    if args.firestore == "memory":
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        fake_db = FakeFirestore(query_latency=args.firestore_latency)
+        seed_products(fake_db, args.products)
+        credentials.Certificate = lambda *a, **k: None
+        firebase_admin.initialize_app = lambda *a, **k: None
+        firestore.client = lambda *a, **k: fake_db
+    else:
+        if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+            raise SystemExit("--firestore emulator needs FIRESTORE_EMULATOR_HOST, e.g. localhost:8080")
+        if os.environ["FIREBASE_SERVICE_ACCOUNT_JSON"] == "{}":
+            # emulator ไม่ตรวจ credential จึงใช้ credential ว่างแทน service account จริง
+            from firebase_admin import credentials
+            project_id = os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-benchmark")
+            credentials.Certificate = lambda *a, **k: EmulatorCredential(project_id)
+
+    import app as chatbot_app
+    chatbot_app.app_logger.setLevel(args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+    return chatbot_app
+
+def load_payloads(path):
+    payloads = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "events" in record:
+                payloads.append(record)
+            else:
+                payloads.append({"text": record.get("text") or record.get("title") or record.get("body", "")})
+    if not payloads:
+        raise SystemExit(f"No payloads found in {path}")
+    return payloads
+
+def build_webhook(payload, index, users):
+    """สร้าง body ที่มี replyToken/webhookEventId ไม่ซ้ำกัน พร้อม signature"""
+    reply_token = uuid.uuid4().hex
+    if "events" in payload:
+        body = json.loads(json.dumps(payload))
+        for event in body["events"]:
+            event["replyToken"] = reply_token
+            event["webhookEventId"] = uuid.uuid4().hex
+    else:
+        body = {"destination": "Ubenchmark", "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "webhookEventId": uuid.uuid4().hex,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": reply_token,
+            "source": {"type": "user", "userId": f"Ubench{index % users:06d}"},
+            "message": {"type": "text", "id": str(index), "text": payload["text"]},
+        }]}
+    raw = json.dumps(body, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), raw.encode(), hashlib.sha256).digest()).decode()
+    return reply_token, raw, signature
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+def run(args):
+    mock = MockServiceServer(args.openai_latency, args.openai_jitter, args.line_latency).start()
+    chatbot_app = load_app(args, mock)
+    payloads = load_payloads(args.payloads)
+    local = threading.local()
+    results = []
+    results_lock = threading.Lock()
+
+    def send(index, measured, scheduled_at=None):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = chatbot_app.app.test_client()
+        reply_token, raw, signature = build_webhook(payloads[index % len(payloads)], index, args.users)
+        # วัดจากเวลาที่ควรส่งตามตาราง ไม่ใช่เวลาที่ thread ว่าง (กัน coordinated omission เมื่อ app รับไม่ทัน)
+        sent_at = scheduled_at or time.time()
+        response = client.post("/callback", data=raw.encode("utf-8"), content_type="application/json",
+                               headers={"X-Line-Signature": signature})
+        acked_at = time.time()
+        if measured:
+            with results_lock:
+                results.append((reply_token, sent_at, acked_at, response.status_code))
+        return reply_token, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        warmup = [pool.submit(send, i, False).result() for i in range(args.warmup)]
+        # ใน async mode งาน warm-up ยังทำอยู่หลังได้ 200 ต้องรอ reply ก่อนนับจำนวนการเรียก OpenAI
+        for reply_token, status in warmup:
+            if status == 200:
+                mock.wait_for_reply(reply_token, args.reply_timeout)
+        openai_calls_before = mock.openai_calls
+        total = int(args.rate * args.duration)
+        start_time = time.time()
+        futures = []
+        for i in range(total):
+            # open loop: ส่งตามเวลาที่กำหนดโดยไม่รอ response ก่อนหน้า
+            scheduled_at = start_time + i / args.rate
+            delay = scheduled_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, args.warmup + i, True, scheduled_at))
+        for future in futures:
+            future.result()
+        send_elapsed = time.time() - start_time
+
+    ack_latencies = [acked - sent for _, sent, acked, _ in results]
+    e2e_latencies = []
+    status_counts = {}
+    last_reply = start_time
+    for reply_token, sent_at, _, status in results:
+        status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+        if status != 200:
+            continue
+        replied_at = mock.wait_for_reply(reply_token, max(0.0, args.reply_timeout - (time.time() - start_time)))
+        if replied_at is not None:
+            e2e_latencies.append(replied_at - sent_at)
+            last_reply = max(last_reply, replied_at)
+    elapsed = max(send_elapsed, last_reply - start_time)
+
+    stages = {}
+    for labels, (count, total_seconds) in chatbot_app.metrics.summary("linebot_stage_duration_seconds").items():
+        stage = dict(labels).get("stage")
+        stages[stage] = {"count": count, "mean": total_seconds / count if count else None}
+
+    report = {
+        "config": {key: getattr(args, key) for key in ("rate", "duration", "concurrency", "products", "firestore",
+                                                        "openai_latency", "line_latency")},
+        "env": args.env,
+        "requests": len(results),
+        "status_counts": status_counts,
+        "replies": len(e2e_latencies),
+        "throughput_rps": len(e2e_latencies) / elapsed if elapsed else 0.0,
+        "ack_latency_seconds": summarize(ack_latencies),
+        "end_to_end_latency_seconds": summarize(e2e_latencies),
+        "openai_calls_per_request": (mock.openai_calls - openai_calls_before) / len(results) if results else 0.0,
+        "stages_seconds": stages,
+    }
+    mock.stop()
+    return report
+
+def print_report(report):
+    def fmt(value):
+        return "-" if value is None else f"{value * 1000:.1f}ms"
+
+    print(f"requests: {report['requests']}  replies: {report['replies']}  status: {report['status_counts']}")
+    print(f"throughput: {report['throughput_rps']:.2f} replies/sec  openai calls/request: {report['openai_calls_per_request']:.2f}")
+    for key in ("ack_latency_seconds", "end_to_end_latency_seconds"):
+        s = report[key]
+        print(f"{key}: p50={fmt(s['p50'])} p95={fmt(s['p95'])} p99={fmt(s['p99'])} max={fmt(s['max'])}")
+    print("stage costs (mean, includes warmup):")
+    for stage, s in sorted(report["stages_seconds"].items(), key=lambda item: -(item[1]["mean"] or 0)):
+        print(f"  {stage:<15} {fmt(s['mean']):>10}  x{s['count']}")
+
+def compare(report, baseline, max_regression):
+    """คืนค่ารายการ regression เทียบกับ baseline"""
+    problems = []
+    current_p95 = report["end_to_end_latency_seconds"]["p95"]
+    baseline_p95 = baseline["end_to_end_latency_seconds"]["p95"]
+    if current_p95 and baseline_p95 and current_p95 > baseline_p95 * (1 + max_regression):
+        problems.append(f"end-to-end p95 {current_p95:.3f}s vs baseline {baseline_p95:.3f}s")
+    if baseline["throughput_rps"] and report["throughput_rps"] < baseline["throughput_rps"] * (1 - max_regression):
+        problems.append(f"throughput {report['throughput_rps']:.2f}/s vs baseline {baseline['throughput_rps']:.2f}/s")
+    return problems
+
+def main():
+    args = parse_args()
+    report = run(args)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.max_regression)
+        if problems:
+            print("PERFORMANCE REGRESSION: " + "; ".join(problems))
+            sys.exit(1)
+        print("No regression against baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# --- ตั้งค่า gunicorn (Procfile: gunicorn -c gunicorn.conf.py app:app) ---
+# preload_app: import app และ module ที่หนักใน master ครั้งเดียว แล้ว fork ให้ทุก worker ใช้ร่วมกัน
+# client (Firestore/OpenAI/LINE) ถูกสร้างหลัง fork ใน post_fork ผ่าน app.warm_up()
+import glob
+import os
+import tempfile
+import threading
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+keepalive = 5
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+# แต่ละ worker เขียน metrics ลงโฟลเดอร์นี้ เพื่อให้ /metrics รวมค่าจากทุก worker (ต้องตั้งก่อน import app)
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"linebot-metrics-{os.getenv('PORT', '10000')}"))
+
+def on_starting(server):
+    # ลบ snapshot ของ worker จากการรันครั้งก่อน
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "worker-*.json*")):
+        os.remove(path)
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.preload_modules()
+
+def post_fork(server, worker):
+    import app
+    app.mark_worker_started()
+    if app.WARM_UP_ON_START:
+        # ทำใน thread แยก เพื่อไม่ให้ worker ช้าในการเริ่มรับ request
+        threading.Thread(target=app.warm_up, name="warm-up", daemon=True).start()
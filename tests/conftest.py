@@ -0,0 +1,12 @@
+import os
+import sys
+
+# app.py อ่านค่าเหล่านี้ตอน import; Firestore/LINE/OpenAI สร้างแบบ lazy จึงไม่มีการเชื่อมต่อจริงในเทสต์
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("FIREBASE_SERVICE_ACCOUNT_JSON", "{}")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench")) # Firestore จำลองใน bench/fakes.py
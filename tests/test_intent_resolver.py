@@ -0,0 +1,41 @@
+import pytest
+
+import app
+
+PRODUCTS = [
+    {"id": "p1", "name": "iPhone 15", "price": 35000, "stock": 100, "category": "Smartphones"},
+    {"id": "p2", "name": "iPhone 15 Pro", "price": 42000, "stock": 20, "category": "Smartphones"},
+    {"id": "p3", "name": "MacBook Air M3", "price": 45000, "stock": 50, "category": "Laptops"},
+    {"id": "p4", "name": "Keyboard", "price": 1500, "stock": 0, "category": "Accessories"},
+]
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    resolver = app.IntentResolver(min_confidence=0.8)
+    index = app._ResolverIndex(1, PRODUCTS)
+    monkeypatch.setattr(resolver, "_get_index", lambda: index)
+    return resolver
+
+
+@pytest.mark.parametrize("message", [
+    "iphone 15 กับ macbook air m3 อันไหนถูกกว่า",
+    "compare iphone 15 and keyboard",
+])
+def test_several_product_names_fall_back_to_openai(resolver, message):
+    assert resolver.resolve(message) is None
+
+
+def test_longer_name_wins_over_contained_name(resolver):
+    assert resolver.resolve("iphone 15 pro ราคาเท่าไหร่") == ("fetch_by_name", {"name": "iPhone 15 Pro"})
+
+
+@pytest.mark.parametrize("message", ["hi", "hey", "hello!", "สวัสดีค่ะ", "ขอบคุณครับ"])
+def test_greetings_are_unknown(resolver, message):
+    assert resolver.resolve(message) == ("unknown", None)
+
+
+@pytest.mark.parametrize("message", ["high", "hint", "hidden"])
+def test_words_starting_with_greeting_are_not_greetings(resolver, message):
+    result = resolver.resolve(message)
+    assert result is None or result[0] != "unknown"
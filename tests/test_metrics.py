@@ -0,0 +1,23 @@
+import os
+
+import app
+
+
+def test_file_store_sums_counters_and_histograms_across_workers(tmp_path):
+    worker = app.Metrics(app.METRIC_BUCKETS)
+    worker.inc("linebot_webhook_requests_total", {"status": "200"}, 3)
+    worker.observe("linebot_stage_duration_seconds", 0.2, {"stage": "reply"})
+    stopped = app.Metrics(app.METRIC_BUCKETS)
+    stopped.inc("linebot_webhook_requests_total", {"status": "200"}, 2)
+    stopped.observe("linebot_stage_duration_seconds", 0.4, {"stage": "reply"})
+
+    # snapshot ของ worker ที่จบไปแล้ว: counter ยังถูกรวม แต่ค่าที่คำนวณตอน scrape ไม่แสดง
+    store = app.MetricsFileStore(stopped, str(tmp_path), 5)
+    store.write([("linebot_webhook_in_flight", {}, 7)])
+    os.replace(store._path(os.getpid()), store._path(999999999))
+
+    body = app.MetricsFileStore(worker, str(tmp_path), 5).render([("linebot_webhook_in_flight", {}, 1)])
+    assert 'linebot_webhook_requests_total{status="200"} 5' in body
+    assert 'linebot_stage_duration_seconds_count{stage="reply"} 2' in body
+    assert f'linebot_webhook_in_flight{{pid="{os.getpid()}"}} 1' in body
+    assert 'pid="999999999"' not in body
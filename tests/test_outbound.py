@@ -0,0 +1,18 @@
+import time
+
+import pytest
+
+import app
+
+
+def test_hedged_call_that_times_out_counts_as_timeout():
+    service = app.OutboundService("test", 0.3, lambda error: False, max_retries=0)
+
+    def slow(timeout):
+        time.sleep(timeout + 0.2)
+
+    with pytest.raises(app.OutboundTimeoutError):
+        service.call(slow, hedge_delay=0.1)
+    assert service.counters["timeouts"] == 1
+    assert service.counters["deadline_skips"] == 0
+    assert service.timeouts_avoided == 0
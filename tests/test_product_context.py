@@ -0,0 +1,25 @@
+import json
+
+import app
+
+
+def _products(count, categories=1):
+    return [
+        {"id": f"p{i}", "name": f"Product {i}", "price": 1000 + i, "stock": i % 3, "category": f"Category {i % categories}"}
+        for i in range(count)
+    ]
+
+
+def test_summary_lines_fit_within_budget():
+    context, tokens = app.build_product_context(_products(200, categories=60), "สินค้าทั้งหมด", token_budget=300)
+    assert "สรุปรายหมวดหมู่" in context
+    assert tokens <= 300
+
+
+def test_query_actions_keep_retrieval_order():
+    products = [
+        {"id": "a", "name": "Cable", "price": 100, "stock": 0, "category": "Accessories"},
+        {"id": "b", "name": "Mouse", "price": 500, "stock": 2, "category": "Accessories"},
+    ]
+    context, _ = app.build_product_context(products, "สินค้าใกล้หมด", action="fetch_low_stock")
+    assert [json.loads(line)["name"] for line in context.splitlines()] == ["Cable", "Mouse"]
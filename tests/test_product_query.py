@@ -0,0 +1,28 @@
+import pytest
+
+import app
+
+
+def test_in_memory_sort_handles_mixed_value_types():
+    products = [
+        {"id": "a", "name": "A", "price": 300, "stock": 1, "category": "X"},
+        {"id": "b", "name": "B", "price": "150", "stock": 1, "category": "X"},
+        {"id": "c", "name": "C", "price": None, "stock": 1, "category": "X"},
+        {"id": "d", "name": "D", "price": 100.5, "stock": 1, "category": "X"},
+    ]
+    spec = app.build_product_query_spec("fetch_top_products", {"sort_by": "price", "order": "asc"})
+    assert [product["id"] for product in app._run_query_in_memory(products, spec)] == ["c", "d", "a", "b"]
+
+
+def test_backfill_makes_legacy_products_searchable(monkeypatch):
+    fakes = pytest.importorskip("fakes")
+    fake_db = fakes.FakeFirestore()
+    products = fake_db.collection("products")
+    products.document("legacy").set({"name": "iPhone 15", "price": 35000, "stock": 3, "category": "Smartphones"})
+    monkeypatch.setattr(app.db, "_client", fake_db)
+    monkeypatch.setattr(app, "PRODUCT_CACHE_ENABLED", False)
+
+    assert app.run_product_query("search_by_name", {"name": "iphone"}) == []
+    assert app.backfill_name_lower() == 1
+    assert [product["id"] for product in app.run_product_query("search_by_name", {"name": "iphone"})] == ["legacy"]
+    assert app.backfill_name_lower() == 0
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import app
+
+
+def _event(event_id, user_id="U1"):
+    return SimpleNamespace(
+        webhook_event_id=event_id,
+        source=SimpleNamespace(user_id=user_id),
+        reply_token=f"reply-{event_id}",
+        message=SimpleNamespace(id=f"m-{event_id}", text="สวัสดี"),
+        timestamp=None,
+        delivery_context=None,
+    )
+
+
+class RecordingStore:
+    def __init__(self):
+        self.keys = []
+
+    def claim(self, key):
+        self.keys.append(key)
+        return True
+
+
+def test_notifies_once_per_throttled_window():
+    limiter = app.UserRateLimiter(per_minute=60, burst=1, max_users=10)
+    assert limiter.allow("U1")
+    assert not limiter.allow("U1")
+    assert limiter.should_notify("U1")
+    assert not limiter.allow("U1")
+    assert not limiter.should_notify("U1")
+
+
+def test_throttled_messages_skip_shared_claim_and_reply_once(monkeypatch):
+    replies = []
+    shared = RecordingStore()
+    monkeypatch.setattr(app, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(app, "user_rate_limiter", app.UserRateLimiter(per_minute=0, burst=0, max_users=10))
+    monkeypatch.setattr(app, "local_event_store", app.MemoryIdempotencyStore(100, 60))
+    monkeypatch.setattr(app, "shared_event_store", shared)
+    monkeypatch.setattr(app, "reply_text", lambda reply_token, text: replies.append((reply_token, text)))
+
+    for event_id in ("e1", "e2", "e3"):
+        app.handle_message(_event(event_id))
+
+    assert shared.keys == []
+    assert replies == [("reply-e1", app.RATE_LIMITED_REPLY)]